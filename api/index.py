@@ -1,256 +1,132 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from gtfs.fetch_reports import fetch_reports
+from http.server import BaseHTTPRequestHandler
 import os
-from datetime import datetime, timedelta
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from zoneinfo import ZoneInfo
-from nyct_gtfs import NYCTFeed  # Using NYCTFeed from nyct_gtfs
-from gtfs.utils import load_stops, is_on_route, haversine_distance, match_gtfs_train, get_nearest_stop, get_direction_from_terminus, get_next_stop
-import psycopg2
-import re 
+from gtfs.feeds import FeedCache, shared_feeds
+from gtfs.reports import decode_reports
+from gtfs.beacon_state import load_states, save_states
+from gtfs.tracing import trace, span
+from gtfs.replay import recording, now as clock_now
+from gtfs.db import acquire, release, to_db_timestamp, insert_reports, insert_trip_mappings, upsert_statuses
+from gtfs.utils import get_route_index, get_topology, get_linear_reference, direction_from_fixes, is_on_route, first_within, match_gtfs_train, STOP_RADIUS
+from gtfs.lines import get_line
+from gtfs.beacons import load_beacons
 import json
-from findmy import KeyPair
-import hashlib
+from urllib.parse import urlparse, parse_qs
+
+def iter_reports(priv_keys, since=None):
+    """gtfs.fetch_reports.iter_reports, imported on first call: it loads findmy and aiohttp."""
+    from gtfs.fetch_reports import iter_reports as fetch
+    return fetch(priv_keys, since=since)
+
+# Constants
+MAX_REPORT_AGE_MIN = 60  # Beacon reports older than 60 minutes => not functioning
+
+# Beacons classified concurrently per run; 1 classifies them one after another
+BEACON_WORKERS = int(os.environ.get("BEACON_WORKERS", "1"))
+
+# Decoded reports are inserted whenever this many are pending, instead of all at the end
+WRITE_BATCH_SIZE = int(os.environ.get("REPORT_WRITE_BATCH_SIZE", "1000"))
 
 class handler(BaseHTTPRequestHandler):
      
-    def get_line_for_beacon(self, beacon_str):
-        """
-        Compute a hash of the beacon string and compare against known values
-        (stored in environment variables) for G and C beacons.
-        
-        The environment variables G_BEACON_HASHES and C_BEACON_HASHES should be comma‐separated lists 
-        of SHA-256 hexdigests.
-        """
-        digest = hashlib.sha256(beacon_str.encode()).hexdigest()
-        g_hashes = {
-            "94f3ac69f181ec7a0d0d013ac32561b5f8bb77140de4df1d7206f5594a212865",
-            "74490939e7d633b32aaf878ca30825a32caa28e510be8e820d3c16ca33b7811f",
-            "ecf02a1da7ccbb631577f16e4c7ee20d93de776f8485c340c6312a68698e0f1a",
-            "8a468700c3b580a79fbc5dbda164211c78b2715e4a5e3545e4550a5a43605c16"
-        }
-        c_hashes = {
-            "41943df1738d6a9e3383396a68fd8408ed0e0a94906b1e9942c8465384a21bae",
-            "9cc3f9bfa0bdbe8bf2e27ae47ff6d2b6614ded0bdc99ec851cad88b53e6d9b41"
-        }
-        
-        if digest in g_hashes:
-            return "G"
-        elif digest in c_hashes:
-            return "C"
-        else:
-            return "unknown" 
-
     def do_GET(self):
+        # Stage timings are always logged; ?trace=1 (or TRACE_RESPONSE=1) also returns them.
+        # With REPLAY_MODE=record the run's raw inputs are archived (see gtfs/replay.py).
+        with trace("index") as run_trace, recording("index"):
+            self.process_beacons(run_trace)
+
+    def process_beacons(self, run_trace):
+        include_trace = "trace" in parse_qs(urlparse(self.path).query) or os.environ.get("TRACE_RESPONSE") == "1"
         results = []  # List to collect results from all beacons
         errors = []   # List to collect any errors
 
-        # Constants
-        STOP_RADIUS = 200  # meters
-        MAX_REPORT_AGE_MIN = 60  # Beacon reports older than 60 minutes => not functioning
-
-        TERMINUS_COORDS = {
-            "F27": (40.644041, -73.979678),  # Church Av (G south terminus)
-            "G22": (40.746554, -73.943832),   # Court Sq (G north terminus)
-            "A09": (40.840719, -73.939561),   # 168 St (C north terminus)
-            "A55": (40.675377, -73.872106)   # Euclid Av (C south terminus)
-        }
-
-        #Grab beacon IDs
-        #beaconId = os.environ.get("BEACON_ID")
-        beaconIds = json.loads(os.environ.get("BEACON_IDS", "[]"))
-
         try:
-            #Connect to DB once, outside the loop
-            conn = psycopg2.connect(
-                host=os.environ.get("PGHOST"),
-                database=os.environ.get("PGDATABASE"),
-                user=os.environ.get("PGUSER"),
-                password=os.environ.get("PGPASSWORD")
-            )
+            # Beacon keys are derived once per process, not per request; a malformed key
+            # is reported as that beacon's error
+            beacons, invalid = load_beacons()
+            beaconIds = list(beacons)
+            errors.extend(invalid)
+
+            #Borrow a pooled DB connection once, outside the loop
+            with span("db_acquire"):
+                conn = acquire()
             cur = conn.cursor()
-            
-            # Delete rows older than 24 hours
-            delete_query = """
-            DELETE FROM \"BeaconReport\"
-            WHERE \"timestamp\" < NOW() - INTERVAL '4 hours';
-            """
-            cur.execute(delete_query)
-            conn.commit()
+
+            # Old rows are removed by dropping partitions in /api/prune.py, not here
             
             #Create a fetch record
             cur.execute("INSERT INTO \"GtfsFetch\" (\"feedName\", \"fetchTime\", \"feedTimestamp\") VALUES (%s, %s, %s) RETURNING id", ("G", "now()", "now()"))
             fetch_id = cur.fetchone()[0]
 
-            all_reports = fetch_reports(beaconIds)
-
-
-            # for each beacon, get reports and push to DB
+            # What each beacon looked like at the end of the previous run
+            states = load_states(cur, {beacon_id: beacon.line for beacon_id, beacon in beacons.items()})
+
+            # Only reports newer than each beacon's last processed one are downloaded
+            since = {beacon.key: states[beacon_id].high_water_mark for beacon_id, beacon in beacons.items()}
+            by_key = {beacon.key: beacon for beacon in beacons.values()}
+
+            # One feed snapshot per line for this run, shared by every beacon
+            feeds = FeedCache(fetch=shared_feeds.get)
+
+            pending_reports = []
+            pending_mappings = []
+            pending_statuses = []
+            outcomes = {}
+            inserted = 0
+            updated_at = clock_now(ZoneInfo("UTC"))
+
+            # Reports stream through fetch -> decode, age/route check and classify -> batched
+            # insert: a beacon is classified as soon as its batch of reports comes back, and
+            # each stage only pulls more when it is ready for it.
+            fetched = iter_reports(list(by_key), since=since)
+            arrived = ((by_key[key], reports) for batch in fetched for key, reports in batch.items() if key in by_key)
+            for beacon, (beacon_result, structured_reports, match, error) in self.classify_stream(arrived, states, feeds):
+                pending_reports.extend(structured_reports)
+                if match:
+                    pending_mappings.append((fetch_id, match[0], beacon.beacon_id, to_db_timestamp(match[1])))
+                if error:
+                    outcomes[beacon.beacon_id] = error
+                else:
+                    outcomes[beacon.beacon_id] = beacon_result
+                    latest_report = structured_reports[-1] if structured_reports else None
+                    pending_statuses.append(self.status_row(beacon_result, latest_report, match, updated_at))
+
+                if len(pending_reports) >= WRITE_BATCH_SIZE:
+                    with span("db_insert", count=len(pending_reports)):
+                        inserted += insert_reports(cur, fetch_id, pending_reports)
+                    pending_reports = []
+
+            # Results in beacon order, whatever order their reports arrived in
             for beacon_str in beaconIds:
-                beacon_result = {}  # Dictionary to store results for this beacon
-                beacon_result["beaconId"] = beacon_str
-                
-                # Determine the line based on the beacon ID.
-                line = self.get_line_for_beacon(beacon_str)
-                beacon_result["line"] = line  # Optional: include for debugging
-
-                try:
-                    # Convert the beacon Base64 string to a KeyPair object
-                    key_obj = KeyPair.from_b64(beacon_str)
-                    # Use the KeyPair object to index the all_reports dictionary
-                    reports = all_reports[key_obj]
-                    
-                    structured_reports = []
-                    
-                    for report in reports:
-                        if "KeyReport(" in str(report):
-                            # Extract data using regex
-                            report_str = str(report)
-                            hashed_key = re.search(r'hashed_adv_key=([^,]+)', report_str).group(1)
-                            timestamp_str = re.search(r'timestamp=([^,]+)', report_str).group(1)
-                            lat = float(re.search(r'lat=([^,]+)', report_str).group(1))
-                            lon = float(re.search(r'lon=([^,\)]+)', report_str).group(1))
-                            
-                            # Parse timestamp
-                            timestamp = datetime.fromisoformat(timestamp_str)
-                            
-                            report_dict = {
-                                "fetchId": fetch_id,
-                                "beaconId": beacon_str,
-                                "hashed_adv_key": hashed_key,
-                                "timestamp": timestamp,
-                                "latitude": lat,
-                                "longitude": lon
-                            }
-
-                            structured_reports.append(report_dict)
-
-                    cur.executemany("INSERT INTO \"BeaconReport\" (\"fetchId\", \"beaconId\",\"hashedAdvKey\", timestamp, latitude, longitude) VALUES ( %(fetchId)s, %(beaconId)s, %(hashed_adv_key)s, %(timestamp)s, %(latitude)s, %(longitude)s)", structured_reports)
-
-                    conn.commit()
-
-                    # process latest report 
-                    if structured_reports:
-                        sorted_reports = sorted(structured_reports, key=lambda r: r["timestamp"], reverse=True)
-
-                        latest_report = sorted_reports[0]
-
-                        beacon_result["timestamp"] = latest_report["timestamp"].isoformat()
-                        beacon_result["location"] = {
-                            "lat": latest_report["latitude"],
-                            "lon": latest_report["longitude"]
-                        }
-
-                        # process report
-                        now = datetime.now(ZoneInfo("US/Eastern"))
-                        age = now - latest_report["timestamp"].astimezone(ZoneInfo("US/Eastern"))
-
-                        # If the latest report is older than 60 minutes, report beacon not functioning.
-                        if age > timedelta(minutes=MAX_REPORT_AGE_MIN):
-                            beacon_result["status"] = "not_functioning"
-                            beacon_result["reason"] = f"Last report is older than {MAX_REPORT_AGE_MIN} minutes"
-
-                        # Check if beacon is on the route.
-                        elif not is_on_route(latest_report["latitude"], latest_report["longitude"], line):
-                            beacon_result["status"] = "not_functioning"
-                            beacon_result["reason"] = "Location not along route"
-                    
-                        else:
-                            at_terminus = False
-
-                            # Check if the most recent beacon report is at a terminus.
-                            for term_id, (term_lat, term_lon) in TERMINUS_COORDS.items():
-                                dist = haversine_distance(latest_report["latitude"], latest_report["longitude"], term_lat, term_lon)
-                                if dist <= STOP_RADIUS:
-                                    beacon_result["status"] = "at_terminus"
-                                    beacon_result["terminus"] = term_id
-                                    at_terminus = True
-                                    break
-
-                            # Try matching a GTFS train
-                            if not at_terminus:
-                        
-                                # Try matching a GTFS train using the last terminus event.
-                                matching_train, last_term_id = match_gtfs_train(reports, line)
-
-                                if matching_train:
-                                    beacon_result["status"] = "matched"
-                                    beacon_result["trainId"] = matching_train.trip_id
-                                    
-                                    #save match to db
-                                    cur.execute("INSERT INTO \"BeaconTripMapping\" (\"fetchId\", \"tripId\", \"beaconId\", \"latestBeaconReport\") VALUES (%s, %s, %s, %s)", (fetch_id, matching_train.trip_id, beacon_str, latest_report["timestamp"]))
-
-                                    conn.commit()
-
-                                else:
-                                    # No matching train found. Report beacon details and determine nearest station & direction.
-                                    beacon_result["status"] = "unmatched"
-                                    
-                                    stops = load_stops(line)
-                                    nearest_stop, distance = get_nearest_stop(latest_report["latitude"], latest_report["longitude"], stops)
-                                    direction = get_direction_from_terminus(last_term_id) if last_term_id else "Unknown"
-                    
-                                    if nearest_stop:
-                                        beacon_result["nearestStop"] = {
-                                            "id": nearest_stop["stop_id"],
-                                            "name": nearest_stop["stop_name"],
-                                            "distance": distance
-                                        }
-
-                                    beacon_result["direction"] = direction
-                                    beacon_result["lastTerminus"] = last_term_id
-
-                                    # If recent report, try next-stop matching
-                                    if (now - latest_report["timestamp"].astimezone(ZoneInfo("US/Eastern"))) <= timedelta(minutes=3):
-                                        # Determine next stop based on the nearest station and direction.
-                                        next_stop = get_next_stop(nearest_stop["stop_id"], direction, stops)
-                                        if next_stop:
-                                            beacon_result["nextStop"] = {
-                                                "id": next_stop["stop_id"],
-                                                "name": next_stop["stop_name"]
-                                            }
-
-                                            # Try to find matching train by next stop
-                                            feed = NYCTFeed(line)
-
-                                            for train in feed.trips:
-                                                if train.stop_time_updates:
-                                                    gtfs_next_stop = train.stop_time_updates[0].stop_id
-                                                    gtfs_next_stop_id = gtfs_next_stop.stop_id
-                                                    base_gtfs_stop_id = gtfs_next_stop_id[:-1] if gtfs_next_stop_id[-1] in ("N", "S") else gtfs_next_stop_id
-                                                                    
-                                                    # Here, we simply check if the next stop's id is in our next stop.
-                                                    if next_stop["stop_id"] == base_gtfs_stop_id:
-                                                        beacon_result["possibleTrain"] = {
-                                                            "id": train.trip_id,
-                                                            "status": train.location_status
-                                                        }
-                                                        break
-                                      
-                    else:
-                        beacon_result["status"] = "no_reports"
-                        beacon_result["reason"] = "No valid beacon reports found"
-
-                    # Add this beacon's result to the collection
-                    results.append(beacon_result)
-
-                except Exception as e:
-                    error_info = {
-                        "beaconId": beacon_str,
-                        "error": str(e)
-                    }
-                    errors.append(error_info)
-                    print(f"Error processing beacon {beacon_str}: {e}")
+                outcome = outcomes.get(beacon_str) or {"beaconId": beacon_str, "error": "No reports returned for beacon"}
+                (errors if "error" in outcome else results).append(outcome)
+
+            # The rest of the run's rows; everything commits in a single transaction
+            with span("db_insert", count=len(pending_reports)):
+                inserted += insert_reports(cur, fetch_id, pending_reports)
+                insert_trip_mappings(cur, pending_mappings)
+                upsert_statuses(cur, pending_statuses)
+                save_states(cur, states.values(), updated_at)
+                conn.commit()
 
             # Prepare the final response
             response = {
                 "fetchId": fetch_id,
-                "timestamp": datetime.now(ZoneInfo("US/Eastern")).isoformat(),
+                "timestamp": clock_now(ZoneInfo("US/Eastern")).isoformat(),
+                "reportsInserted": inserted,
                 "beacons": results
             }
 
             if errors:
                 response["errors"] = errors
 
+            if include_trace:
+                response["trace"] = run_trace.summary()
+
             # Send the consolidated response
             self.send_response(200)
             self.send_header("Content-type", "application/json")
@@ -270,13 +146,195 @@ class handler(BaseHTTPRequestHandler):
             if 'cur' in locals() and cur is not None:
                 cur.close()
             if 'conn' in locals() and conn is not None:
-                conn.close()
+                release(conn)
+
+    def classify_beacon(self, beacon, reports, state, feeds):
+        """
+        Classify one beacon from its fetched reports (oldest first). Only shared read-only data (route and
+        stop indexes, the run's feed snapshots) and the beacon's own state are touched, so
+        beacons can be classified in parallel.
+        Returns (result, decoded reports, (trip id, report time) of a match or None, error or None).
+        """
+        beacon_str = beacon.beacon_id
+        line = state.line
+        beacon_result = {}  # Dictionary to store results for this beacon
+        beacon_result["beaconId"] = beacon_str
+        beacon_result["line"] = line  # Optional: include for debugging
+        structured_reports = []
+        match = None
+
+        try:
+            with span("report_decode", count=len(reports)):
+                structured_reports = decode_reports(beacon_str, reports)
+
+            # Only reports newer than the previous run are scanned for a terminus event
+            state.advance(structured_reports)
+
+            # process latest report 
+            if structured_reports:
+                latest_report = structured_reports[-1]
+
+                beacon_result["timestamp"] = latest_report.timestamp.isoformat()
+                beacon_result["location"] = {
+                    "lat": latest_report.latitude,
+                    "lon": latest_report.longitude
+                }
+
+                # process report
+                now = clock_now(ZoneInfo("US/Eastern"))
+                age = now - latest_report.timestamp.astimezone(ZoneInfo("US/Eastern"))
+
+                # If the latest report is older than 60 minutes, report beacon not functioning.
+                if age > timedelta(minutes=MAX_REPORT_AGE_MIN):
+                    beacon_result["status"] = "not_functioning"
+                    beacon_result["reason"] = f"Last report is older than {MAX_REPORT_AGE_MIN} minutes"
+
+                # Check if beacon is on the route.
+                elif not is_on_route(latest_report.latitude, latest_report.longitude, line):
+                    beacon_result["status"] = "not_functioning"
+                    beacon_result["reason"] = "Location not along route"
+
+                else:
+                    at_terminus = False
+
+                    # Check if the most recent beacon report is at a terminus.
+                    term_id = first_within(latest_report.latitude, latest_report.longitude, get_line(line).termini, STOP_RADIUS)
+                    if term_id:
+                        beacon_result["status"] = "at_terminus"
+                        beacon_result["terminus"] = term_id
+                        at_terminus = True
+
+                    # Try matching a GTFS train
+                    if not at_terminus:
+
+                        # Try matching a GTFS train using the last terminus event.
+                        matching_train, last_term_id = match_gtfs_train(structured_reports, line, feeds=feeds, state=state)
+
+                        if matching_train:
+                            beacon_result["status"] = "matched"
+                            beacon_result["trainId"] = matching_train.trip_id
+                            state.trip_id = matching_train.trip_id
+
+                            #save match to db (written with the rest of the run)
+                            match = (matching_train.trip_id, latest_report.timestamp)
+
+                        else:
+                            # No matching train found. Report beacon details and determine nearest station & direction.
+                            beacon_result["status"] = "unmatched"
+
+                            topology = get_topology(line)
+                            nearest_stop, distance = topology.nearest_stop(latest_report.latitude, latest_report.longitude)
+                            direction = state.direction or "Unknown"
+                            if direction == "Unknown":
+                                # No terminus seen yet: infer it from how the beacon moved along the line
+                                direction = direction_from_fixes(structured_reports, line)
+
+                            if nearest_stop:
+                                beacon_result["nearestStop"] = {
+                                    "id": nearest_stop["stop_id"],
+                                    "name": nearest_stop["stop_name"],
+                                    "distance": distance
+                                }
+
+                            beacon_result["direction"] = direction
+
+                            # Meters left along the line to the terminus it is heading for
+                            ref = get_linear_reference(line)
+                            chainage, _ = ref.locate(latest_report.latitude, latest_report.longitude) if ref else (None, None)
+                            if chainage is not None and direction != "Unknown":
+                                beacon_result["distanceToTerminus"] = round(ref.distance_to_terminus(chainage, direction))
+
+                            beacon_result["lastTerminus"] = last_term_id
+
+                            # If recent report, try next-stop matching
+                            if (now - latest_report.timestamp.astimezone(ZoneInfo("US/Eastern"))) <= timedelta(minutes=3):
+                                # Determine next stop based on the nearest station and direction.
+                                next_stop = topology.next_stop(nearest_stop["stop_id"], direction) if nearest_stop else None
+                                if next_stop:
+                                    beacon_result["nextStop"] = {
+                                        "id": next_stop["stop_id"],
+                                        "name": next_stop["stop_name"]
+                                    }
+
+                                    # Try to find matching train by next stop
+                                    feed = feeds.get(line)
+
+                                    for train in feed.trips:
+                                        if train.stop_time_updates:
+                                            gtfs_next_stop_id = train.stop_time_updates[0].stop_id
+                                            base_gtfs_stop_id = gtfs_next_stop_id[:-1] if gtfs_next_stop_id[-1] in ("N", "S") else gtfs_next_stop_id
+
+                                            # Here, we simply check if the next stop's id is in our next stop.
+                                            if next_stop["stop_id"] == base_gtfs_stop_id:
+                                                beacon_result["possibleTrain"] = {
+                                                    "id": train.trip_id,
+                                                    "status": train.location_status
+                                                }
+                                                break
+
+            else:
+                beacon_result["status"] = "no_reports"
+                beacon_result["reason"] = "No valid beacon reports found"
+
+        except Exception as e:
+            print(f"Error processing beacon {beacon_str}: {e}")
+            return None, structured_reports, None, {"beaconId": beacon_str, "error": str(e)}
+
+        return beacon_result, structured_reports, match, None
+
+    def status_row(self, beacon_result, latest_report, match, updated_at):
+        """The beacon's "BeaconStatus" row; tripId / latestBeaconReport are only set on a match."""
+        next_stop = beacon_result.get("nextStop") or {}
+        trip_id, matched_report_at = match or (None, None)
+        return (
+            beacon_result["beaconId"],
+            beacon_result["line"],
+            beacon_result["status"],
+            beacon_result.get("reason"),
+            latest_report.latitude if latest_report else None,
+            latest_report.longitude if latest_report else None,
+            to_db_timestamp(latest_report.timestamp) if latest_report else None,
+            trip_id,
+            to_db_timestamp(matched_report_at),
+            next_stop.get("id"),
+            next_stop.get("name"),
+            to_db_timestamp(updated_at),
+        )
+
+    def classify_stream(self, arrived, states, feeds):
+        """
+        classify_beacon() each (beacon, reports) of arrived as it comes in, yielding
+        (beacon, outcome) in the same order. With BEACON_WORKERS > 1 beacons are classified
+        on a thread pool, with at most 2 * BEACON_WORKERS of them in flight.
+        """
+        def classify(beacon, reports):
+            return self.classify_beacon(beacon, reports, states[beacon.beacon_id], feeds)
+
+        if BEACON_WORKERS <= 1:
+            for beacon, reports in arrived:
+                yield beacon, classify(beacon, reports)
+            return
+
+        # Build the shared indexes once, before the workers race to build them
+        for line in {state.line for state in states.values()}:
+            if get_line(line):
+                get_route_index(line)
+                get_topology(line)
+                get_linear_reference(line)
+
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=BEACON_WORKERS) as pool:
+            for beacon, reports in arrived:
+                # Each task runs in a copy of this context, so spans and the replay clock carry over
+                in_flight.append((beacon, pool.submit(contextvars.copy_context().run, classify, beacon, reports)))
+                if len(in_flight) >= 2 * BEACON_WORKERS:
+                    beacon, future = in_flight.popleft()
+                    yield beacon, future.result()
+            while in_flight:
+                beacon, future = in_flight.popleft()
+                yield beacon, future.result()
+
 
 if __name__ == '__main__':
-    # Define server address and port
-    server_address = ('', 8000)  # '' binds to all available interfaces
-    httpd = HTTPServer(server_address, handler)
-    print("Server running on port 8000...")
-    
-    # Run the server until interrupted
-    httpd.serve_forever()
+    from server import serve
+    serve({"/api/index.py": handler})
@@ -0,0 +1,32 @@
+from http.server import BaseHTTPRequestHandler
+from gtfs.retention import prune
+import json
+from gtfs.db import acquire, release
+
+class handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        """
+        Retention job: create upcoming partitions and drop expired ones.
+        Scheduled on its own so that the beacon request path does no retention work.
+        """
+        try:
+            conn = acquire()
+            dropped = prune(conn)
+
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"dropped": dropped}).encode("utf-8"))
+
+        except Exception as e:
+            error_msg = f"Server error: {str(e)}"
+            print(error_msg)
+            self.send_response(500)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": error_msg}).encode("utf-8"))
+
+        finally:
+            if 'conn' in locals() and conn is not None:
+                release(conn)
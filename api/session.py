@@ -0,0 +1,52 @@
+from http.server import BaseHTTPRequestHandler
+import hmac
+import json
+import os
+from urllib.parse import urlparse, parse_qs
+
+def is_cron_request(headers):
+    """
+    True if the request carries Vercel's "Authorization: Bearer $CRON_SECRET" header.
+    Without CRON_SECRET configured no request can prove it comes from the scheduler.
+    """
+    secret = os.environ.get("CRON_SECRET")
+    if not secret:
+        return False
+    return hmac.compare_digest(headers.get("Authorization", ""), f"Bearer {secret}")
+
+class handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        """
+        Keep the saved Apple session fresh. Scheduled separately from /api/index.py so that
+        a full re-login (which may wait on a Twilio SMS) never lands on the beacon request path.
+        ?force=1 re-authenticates even a fresh session; it needs the cron secret, since every
+        forced run can send an Apple 2FA code.
+        """
+        force = "force" in parse_qs(urlparse(self.path).query)
+        authorized = is_cron_request(self.headers)
+
+        # With CRON_SECRET set only the scheduler may refresh; without it, only unforced
+        # refreshes (a no-op until the session is due) are allowed.
+        if (force or os.environ.get("CRON_SECRET")) and not authorized:
+            self.send_response(401)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": "Unauthorized"}).encode("utf-8"))
+            return
+
+        try:
+            from gtfs.fetch_reports import refresh_session
+            refreshed = refresh_session(force=force)
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"refreshed": refreshed}).encode("utf-8"))
+
+        except Exception as e:
+            error_msg = f"Server error: {str(e)}"
+            print(error_msg)
+            self.send_response(500)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": error_msg}).encode("utf-8"))
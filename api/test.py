@@ -1,12 +1,6 @@
-from google.transit.gtfs_realtime_pb2 import FeedMessage
-import requests
-import psycopg2
-import psycopg2.extras
-import os
-from os.path import join
-import json
+from gtfs.db import acquire, release
+from gtfs.vehicle_positions import VEHICLE_FEEDS, load_feed_states, poll_feeds, store_feeds
 from http.server import BaseHTTPRequestHandler
-from datetime import datetime
 
 
 
@@ -14,89 +8,29 @@ class handler(BaseHTTPRequestHandler):
 
     def do_GET(self):
 
-        # Get stop data
-        with open(join('gtfs', 'stops.json'), "r") as f:
-            stops = json.load(f)
-            message2 = json.dumps(stops)
-
-
-        # Fetch GTFS realtime data
-        MTA_FEEDS = [
-            {
-            "name": "G",
-            "url": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-g",
-            }
-        ];
-
-        # Connect to the database once, outside the loop
-        conn = psycopg2.connect(
-            host=os.environ.get("PGHOST"),
-            database=os.environ.get("PGDATABASE"),
-            user=os.environ.get("PGUSER"),
-            password=os.environ.get("PGPASSWORD")
-        )
+        # Borrow a pooled connection
+        conn = acquire()
         cur = conn.cursor()
-        updates = []
-
-        try: 
-
-            #create a fetch record
-            cur.execute("INSERT INTO \"GtfsFetch\" (\"feedName\", \"fetchTime\", \"feedTimestamp\") VALUES (%s, %s, %s) RETURNING id", ("G", "now()", "now()"))
-            fetch_id = cur.fetchone()[0]
-
-            for feed_info in MTA_FEEDS:
-                print(f"Fetching {feed_info['name']} data")
-
-                response = requests.get(feed_info['url'])
-                response.raise_for_status()
-
-                feed = FeedMessage()
-                feed.ParseFromString(response.content)
-
-                for entity in feed.entity:
-                    if not entity.HasField('vehicle'): continue
-                    vehicle = entity.vehicle
 
-                    print('entity: ', entity)
-                    print('vehicle: ', vehicle)
-                    print('stop id: ', vehicle.stop_id)
-                    print('stop', stops[vehicle.stop_id])
+        try:
 
-                    update = {
-                                'fetchId': fetch_id,
-                                'entityId': entity.id,
-                                'tripId': vehicle.trip.trip_id,
-                                'routeId': vehicle.trip.route_id,
-                                'startTime': vehicle.trip.start_time,
-                                'startDate': vehicle.trip.start_date,
-                                'scheduleRelationship': vehicle.trip.schedule_relationship,
-                                'stopId': vehicle.stop_id if vehicle.HasField('stop_id') else None,
-                                'stopLat': float(stops[vehicle.stop_id]['stop_lat']),
-                                'stopLon': float(stops[vehicle.stop_id]['stop_lon']),
-                                'currentStatus': vehicle.current_status if vehicle.HasField('current_status') else None,
-                                'timestamp': datetime.fromtimestamp(vehicle.timestamp) if vehicle.HasField('timestamp') else None
-                            }
-                    
-                    updates.append(update)
+            # Poll every feed concurrently; unchanged feeds are neither parsed nor stored
+            states = load_feed_states(cur, VEHICLE_FEEDS)
+            results, errors = poll_feeds(states)
 
-                # Insert the data into the database
-                if len(updates) > 0:
-                    columns = updates[0].keys()
-                    values = [[position[column] for column in columns] for position in updates]
+            # Store the entities that changed, from every feed, at once
+            stored = store_feeds(cur, results)
+            conn.commit()
 
-                    query = f"INSERT INTO \"VehiclePosition\" (\"fetchId\", \"entityId\", \"tripId\", \"routeId\", \"startTime\", \"startDate\", \"scheduleRelationship\", \"stopId\", \"stopLat\", \"stopLon\", \"currentStatus\", \"timestamp\") VALUES %s"
-                    
-                    psycopg2.extras.execute_values(cur, query, values)
-
-                    conn.commit()
-
-                    message = f"Stored {len(updates)} vehicle positions"
-                    print(message)
-
-                else:
-                    message = "No updates found"
-                    print(message)
+            changed = [r.name for r in results if r.status == "changed"]
+            if changed:
+                message = f"Stored {stored} changed vehicle positions from {len(changed)} feeds ({', '.join(changed)})"
+            else:
+                message = "No updates found"
 
+            if errors:
+                message += "; failed feeds: " + ", ".join(f"{name} ({error})" for name, error in errors.items())
+            print(message)
 
         except Exception as e:
             message = f"Error: {str(e)}"
@@ -107,7 +41,7 @@ class handler(BaseHTTPRequestHandler):
             if cur is not None:
                 cur.close()
             if conn is not None:
-                conn.close()
+                release(conn)
 
         print("Done fetching data")
 
@@ -116,7 +50,3 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
 
         self.wfile.write(message.encode('utf-8'))
-
-
-
-
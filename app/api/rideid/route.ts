@@ -5,14 +5,11 @@ import { PrismaClient } from "@prisma/client";
 const prisma = new PrismaClient();
 
 export async function GET() {
-  // Get the latest beacon report for every unique beaconId
-  const beacons = await prisma.beaconTripMapping.findMany({
-    distinct: ['beaconId'],
-    orderBy: [
-      { beaconId: 'asc' },            // Group by beaconId
-      { latestBeaconReport: 'desc' }  // For each group, take the most recent report
-    ],
+  // One row per beacon, kept current by /api/index.py; only beacons that have matched a trip
+  const beacons = await prisma.beaconStatus.findMany({
+    where: { tripId: { not: null } },
+    orderBy: { beaconId: 'asc' },
   });
 
   return NextResponse.json(beacons);
-}
\ No newline at end of file
+}
@@ -0,0 +1,213 @@
+"""
+Offline benchmark for the beacon pipeline.
+
+    python -m bench                       # hot paths + /api/index.py at 1..1000 beacons
+    python -m bench --scales 1,10,100 --repeat 5
+    python -m bench --json out.json       # save the results
+    python -m bench --compare base.json   # fail if throughput dropped more than --tolerance
+    python -m bench record                # save the live G/C feeds as fixtures
+    python -m bench replay /tmp/replay    # re-run archived production runs (REPLAY_MODE=record)
+    python -m bench replay /tmp/replay --match-window 180 --stop-radius 150
+    python -m bench coldstart             # import time of each handler; fails over budget
+    python -m bench check                 # incremental fetch edge cases (bench/state_check.py)
+
+Beacon histories are synthetic (see bench/synthetic.py); the Find My fetch and Postgres are
+replaced by local stand-ins and GTFS feeds come from bench/fixtures (recorded or synthesized).
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("BLOB_KEY", "YmVuY2htYXJrLW9ubHktbm90LWEtcmVhbC1zZWNyZXQ=")
+
+from bench.pipeline import count_statuses, patched_index, quiet
+
+LINES = ("G", "C")
+DEFAULT_SCALES = (1, 10, 100, 1000)
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {"p50": pct(50), "p90": pct(90), "p99": pct(99), "max": ordered[-1]}
+
+
+def _ms(stats):
+    return {k: round(v * 1000, 3) for k, v in stats.items()}
+
+
+def bench_hot_paths(beacons, feeds):
+    """Per-call latency of the gtfs.utils hot paths over every synthetic beacon."""
+    from gtfs.reports import decode_reports
+    from gtfs.utils import (direction_from_fixes, get_last_terminus_report, get_nearest_stop, is_on_route,
+                            load_stops, match_gtfs_train)
+
+    stops = {line: load_stops(line) for line in LINES}
+    timings = {"is_on_route": [], "get_last_terminus_report": [], "get_nearest_stop": [], "match_gtfs_train": [],
+               "direction_from_fixes": []}
+    with quiet():
+        for beacon in beacons:
+            reports = decode_reports(beacon.beacon_id, beacon.reports)
+            latest = reports[-1]
+            calls = {
+                "is_on_route": lambda: is_on_route(latest.latitude, latest.longitude, beacon.line),
+                "get_last_terminus_report": lambda: get_last_terminus_report(reports, beacon.line),
+                "get_nearest_stop": lambda: get_nearest_stop(latest.latitude, latest.longitude, stops[beacon.line]),
+                "match_gtfs_train": lambda: match_gtfs_train(reports, beacon.line, feeds=feeds),
+                "direction_from_fixes": lambda: direction_from_fixes(reports, beacon.line),
+            }
+            for name, call in calls.items():
+                start = time.perf_counter()
+                call()
+                timings[name].append(time.perf_counter() - start)
+    return {name: _ms(percentiles(samples)) for name, samples in timings.items()}
+
+
+def bench_pipeline(beacons, feed_data, repeat):
+    """Wall time of complete /api/index.py runs, with every external service stubbed out."""
+    from bench.fixtures import snapshot_from_bytes
+    from bench.stubs import fake_fetch_reports
+
+    lines = {beacon.beacon_id: beacon.line for beacon in beacons}
+    runs, response = [], None
+    with patched_index(
+        fake_fetch_reports(beacons),
+        lambda line: snapshot_from_bytes(line, feed_data[line]),
+        lines,
+        line_for=lambda beacon_str: lines.get(beacon_str, "unknown"),
+    ) as run_once:
+        for _ in range(repeat):
+            elapsed, response = run_once()
+            runs.append(elapsed)
+
+    median = statistics.median(runs)
+    statuses = count_statuses(response)
+    return {
+        "run_ms": _ms(percentiles(runs)),
+        "beacons_per_sec": round(len(beacons) / median, 1) if median else None,
+        "statuses": statuses,
+        # The unmatched branch (nearest stop, next stop, possible train) is the slowest per beacon
+        "unmatched": statuses.get("unmatched", 0),
+        "errors": len(response.get("errors", [])),
+        "stages": response.get("trace", {}).get("stages", {}),
+    }
+
+
+def run(scales, repeat, source):
+    from bench.fixtures import feed_bytes, snapshot_from_bytes
+    from bench.synthetic import make_beacons
+    from gtfs.feeds import FeedCache
+
+    results = []
+    for n in scales:
+        beacons = make_beacons(n, LINES)
+        feed_data = {line: feed_bytes(line, beacons, source) for line in LINES}
+        feeds = FeedCache(fetch=lambda line: snapshot_from_bytes(line, feed_data[line]))
+        result = {
+            "beacons": n,
+            "hot_paths_ms": bench_hot_paths(beacons, feeds),
+            "pipeline": bench_pipeline(beacons, feed_data, repeat),
+        }
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def print_result(result):
+    pipeline = result["pipeline"]
+    print(f"\n== {result['beacons']} beacons: {pipeline['beacons_per_sec']} beacons/sec, "
+          f"run p50 {pipeline['run_ms']['p50']} ms, p90 {pipeline['run_ms']['p90']} ms, "
+          f"p99 {pipeline['run_ms']['p99']} ms")
+    print(f"   statuses {pipeline['statuses']}, unmatched {pipeline['unmatched']}, errors {pipeline['errors']}")
+    for name, stats in result["hot_paths_ms"].items():
+        print(f"   {name:<26} p50 {stats['p50']:>8} ms  p90 {stats['p90']:>8} ms  p99 {stats['p99']:>8} ms")
+    for stage, stats in sorted(pipeline["stages"].items(), key=lambda item: -item[1]["total_ms"]):
+        print(f"   stage {stage:<20} {stats['total_ms']:>10} ms over {stats['calls']} calls")
+
+
+def compare(results, baseline_path, tolerance):
+    """Return the scales whose throughput fell more than tolerance below the baseline's."""
+    with open(baseline_path) as f:
+        baseline = {r["beacons"]: r for r in json.load(f)}
+    regressions = []
+    for result in results:
+        base = baseline.get(result["beacons"])
+        if not base or not base["pipeline"]["beacons_per_sec"]:
+            continue
+        now, before = result["pipeline"]["beacons_per_sec"], base["pipeline"]["beacons_per_sec"]
+        if now < before * (1 - tolerance):
+            regressions.append(f"{result['beacons']} beacons: {now} beacons/sec, baseline {before}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", choices=("run", "record", "replay", "coldstart", "check"), default="run")
+    parser.add_argument("archive", nargs="?", help="replay: recorded run directory or a directory of them")
+    parser.add_argument("--scales", default=",".join(map(str, DEFAULT_SCALES)), help="comma-separated beacon counts")
+    parser.add_argument("--repeat", type=int, default=3, help="pipeline runs per scale")
+    parser.add_argument("--feeds", choices=("auto", "recorded", "synthetic"), default="auto")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results file to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop (fraction)")
+    parser.add_argument("--match-window", type=float, help="replay: override MATCH_WINDOW_SEC")
+    parser.add_argument("--stop-radius", type=float, help="replay: override STOP_RADIUS")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="coldstart: multiply every budget")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        from bench.fixtures import record
+        record(LINES)
+        return 0
+
+    if args.command == "coldstart":
+        from bench.coldstart import coldstart, print_coldstart
+        results, violations = coldstart(repeat=args.repeat, budget_scale=args.budget_scale)
+        print_coldstart(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        for violation in violations:
+            print(f"OVER BUDGET {violation}")
+        return 1 if violations else 0
+
+    if args.command == "check":
+        from bench.state_check import print_checks, run_checks
+        results = run_checks()
+        print_checks(results)
+        return 1 if any(results.values()) else 0
+
+    logging.getLogger("gtfs.tracing").setLevel(logging.WARNING)
+    if args.command == "replay":
+        from bench.replay import print_summary, replay
+        if not args.archive:
+            parser.error("replay needs an archive directory")
+        summary = replay(args.archive, args.match_window, args.stop_radius)
+        print_summary(summary)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(summary, f, indent=2)
+        return 0
+
+    results = run([int(n) for n in args.scales.split(",")], args.repeat, args.feeds)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
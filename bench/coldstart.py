@@ -0,0 +1,79 @@
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+# Import-time profile of the serverless entry points. Every cron invocation may land on a
+# fresh instance, which pays for importing its handler module before it does any work.
+# Each handler is imported in a new interpreter with -X importtime; the heavy dependencies
+# its code paths load on demand (findmy, nyct_gtfs, ...) must not show up at import.
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Median import time allowed per handler module (ms), with headroom over what they take today
+COLD_START_BUDGET_MS = {
+    "api.index": 300,
+    "api.session": 100,
+    "api.prune": 120,
+    "api.test": 300,
+}
+
+# Packages each handler must only import when a request needs them
+NOT_AT_IMPORT = {
+    "api.index": ("findmy", "aiohttp", "nyct_gtfs", "cryptography", "vercel_blob", "requests"),
+    "api.session": ("findmy", "aiohttp", "cryptography", "vercel_blob", "numpy", "psycopg2"),
+    "api.prune": ("findmy", "numpy", "nyct_gtfs", "requests", "cryptography"),
+    "api.test": ("findmy", "numpy", "cryptography", "vercel_blob"),
+}
+
+
+def import_profile(module):
+    """Import module in a fresh interpreter; returns (total ms, {top-level package: self ms})."""
+    env = {k: v for k, v in os.environ.items() if k != "BLOB_KEY"}  # importing must not need secrets
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    total, packages = None, {}
+    for row in result.stderr.splitlines():
+        if not row.startswith("import time:") or "|" not in row:
+            continue
+        self_us, cumulative_us, name = (field.strip() for field in row[len("import time:"):].split("|"))
+        if not self_us.isdigit():
+            continue  # header row
+        root = name.split(".")[0]
+        packages[root] = packages.get(root, 0) + int(self_us) / 1000
+        if name == module:
+            total = int(cumulative_us) / 1000
+    return total, packages
+
+
+def coldstart(modules=tuple(COLD_START_BUDGET_MS), repeat=5, budget_scale=1.0):
+    """Profile each handler repeat times; returns (results, budget or import violations)."""
+    results, violations = [], []
+    for module in modules:
+        runs = [import_profile(module) for _ in range(repeat)]
+        total = statistics.median(total for total, _ in runs)
+        packages = runs[-1][1]
+        budget = COLD_START_BUDGET_MS.get(module)
+        results.append({
+            "module": module,
+            "import_ms": round(total, 1),
+            "budget_ms": budget * budget_scale if budget else None,
+            "packages_ms": {name: round(ms, 1) for name, ms in sorted(packages.items(), key=lambda p: -p[1])[:10]},
+        })
+        if budget and total > budget * budget_scale:
+            violations.append(f"{module}: {total:.1f} ms to import, budget {budget * budget_scale:.0f} ms")
+        loaded = [name for name in NOT_AT_IMPORT.get(module, ()) if name in packages]
+        if loaded:
+            violations.append(f"{module}: imports {', '.join(loaded)} at module import")
+    return results, violations
+
+
+def print_coldstart(results):
+    for result in results:
+        print(f"\n== {result['module']}: {result['import_ms']} ms to import (budget {result['budget_ms']} ms)")
+        for name, ms in result["packages_ms"].items():
+            print(f"   {name:<24} {ms:>8} ms")
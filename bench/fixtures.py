@@ -0,0 +1,114 @@
+import random
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
+import requests
+from nyct_gtfs import NYCTFeed
+from nyct_gtfs.compiled_gtfs import nyct_subway_pb2
+from nyct_gtfs.compiled_gtfs.gtfs_realtime_pb2 import FeedMessage
+from gtfs.feeds import FeedSnapshot, feed_url
+from gtfs.tracing import span
+from gtfs.lines import get_line
+from gtfs.utils import MATCH_WINDOW_SEC
+
+# GTFS-realtime fixtures. Recorded feeds (python -m bench record) are stored as
+# bench/fixtures/<line>.pb and used as they are; without one, a feed in the same NYCT format is
+# synthesized with a trip for (most of) the synthetic beacons' trains plus unrelated background trips.
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures"
+EASTERN = ZoneInfo("US/Eastern")
+
+
+def fixture_path(line):
+    return FIXTURE_DIR / f"{line.lower()}.pb"
+
+
+def record(lines):
+    """Save the current live feed of each line as a fixture."""
+    FIXTURE_DIR.mkdir(exist_ok=True)
+    for line in lines:
+        response = requests.get(feed_url(line), timeout=10)
+        response.raise_for_status()
+        fixture_path(line).write_bytes(response.content)
+        print(f"Recorded {line} feed: {len(response.content)} bytes -> {fixture_path(line)}")
+
+
+def _add_trip(feed, line, departed_at, destination, index, now_ts):
+    eastern = departed_at.astimezone(EASTERN)
+    minutes = eastern.hour * 60 + eastern.minute + eastern.second / 60
+    direction = destination[-1]
+    trip_id = f"{round(minutes * 100):06d}_{line}..{direction}"
+    train_id = f"0{line} {index:04d}+ SYN/SYN"
+
+    entity = feed.entity.add()
+    entity.id = f"{index:06d}T"
+    trip = entity.trip_update.trip
+    trip.trip_id = trip_id
+    trip.route_id = line
+    trip.start_date = eastern.strftime("%Y%m%d")
+    descriptor = trip.Extensions[nyct_subway_pb2.nyct_trip_descriptor]
+    descriptor.train_id = train_id
+    descriptor.is_assigned = True
+    descriptor.direction = 1 if direction == "N" else 3
+
+    sequence = get_line(line).sequence if direction == "S" else get_line(line).sequence[::-1]
+    for offset, stop_id in enumerate(sequence[len(sequence) // 2:]):
+        update = entity.trip_update.stop_time_update.add()
+        update.stop_id = stop_id + direction
+        update.arrival.time = now_ts + 120 * (offset + 1)
+
+    vehicle = feed.entity.add()
+    vehicle.id = f"{index:06d}V"
+    vehicle.vehicle.trip.CopyFrom(trip)
+    vehicle.vehicle.timestamp = now_ts - 30
+    vehicle.vehicle.stop_id = sequence[len(sequence) // 2] + direction
+    vehicle.vehicle.current_status = 2
+
+
+def synthesize(line, beacons, background=40, match_rate=0.8, seed=0):
+    """
+    An NYCT-format feed for line with a trip for match_rate of the synthetic beacons' trains,
+    departing when they did. Background trips stay clear of every beacon train's match
+    window, so the rest of the beacons come out unmatched.
+    """
+    rng = random.Random(seed)
+    expected_termini = get_line(line).expected_termini
+    now_ts = int(time.time())
+    feed = FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = now_ts
+    feed.header.Extensions[nyct_subway_pb2.nyct_feed_header].nyct_subway_version = "1.0"
+
+    trains = sorted({(beacon.terminus_id, beacon.departed_at) for beacon in beacons if beacon.line == line})
+    index = 0
+    for term_id, departed_at in trains:
+        if rng.random() > match_rate:
+            continue
+        _add_trip(feed, line, departed_at, expected_termini[term_id], index, now_ts)
+        index += 1
+    # A terminus event can be a report interval or two off the departure; keep twice the window clear
+    clearance = 2 * MATCH_WINDOW_SEC
+    for _ in range(background):
+        term_id = rng.choice(sorted(expected_termini))
+        departed_ts = now_ts - rng.uniform(0, 5400)
+        if any(t == term_id and abs(departed_at.timestamp() - departed_ts) < clearance for t, departed_at in trains):
+            continue
+        _add_trip(feed, line, datetime.fromtimestamp(departed_ts, timezone.utc), expected_termini[term_id], index, now_ts)
+        index += 1
+    return feed.SerializeToString()
+
+
+def feed_bytes(line, beacons, source="auto"):
+    """The fixture for line: "recorded", "synthetic", or "auto" (recorded if there is one)."""
+    if source == "recorded" or (source == "auto" and fixture_path(line).exists()):
+        return fixture_path(line).read_bytes()
+    return synthesize(line, beacons)
+
+
+def snapshot_from_bytes(line, data):
+    """Parse fixture bytes the way fetch_feed parses a live response."""
+    with span("feed_load"):
+        feed = NYCTFeed(line, fetch_immediately=False)
+        feed.load_gtfs_bytes(data)
+        return FeedSnapshot(line, feed)
@@ -0,0 +1,113 @@
+import contextlib
+import io
+import json
+import os
+import time
+from bench.stubs import FakeConnection
+
+# Runs /api/index.py in-process with its external services swapped for local ones.
+
+
+@contextlib.contextmanager
+def quiet():
+    """The pipeline prints diagnostics per beacon; keep them out of the measurements' output."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class MemoryStates:
+    """Keeps BeaconState between runs in memory, in place of the "BeaconState" table."""
+
+    def __init__(self):
+        self.saved = {}
+
+    def load_states(self, cur, beacon_lines):
+        from gtfs.beacon_state import BeaconState
+
+        states = {}
+        for beacon_id, line in beacon_lines.items():
+            state = self.saved.get(beacon_id)
+            states[beacon_id] = state if state is not None and state.line == line else BeaconState(beacon_id, line)
+        return states
+
+    def save_states(self, cur, states, updated_at):
+        for state in states:
+            self.saved[state.beacon_id] = state
+
+
+def in_batches(reports, batch_size=16):
+    """Hand fetch_reports' result over in batches, the way iter_reports streams it."""
+    items = list(reports.items())
+    for i in range(0, len(items), batch_size):
+        yield dict(items[i:i + batch_size])
+
+
+@contextlib.contextmanager
+def patched_index(fetch_reports, fetch_feed, beacon_ids, line_for=None, states=None):
+    """
+    Yield a function that runs one request through api.index.handler and returns
+    (seconds, response dict). fetch_feed(line) returns a FeedSnapshot; line_for overrides the
+    beacon -> line mapping (through BEACON_LINES); states (a MemoryStates) carries beacon state from run to run.
+    """
+    import api.index
+    from gtfs.beacons import key_digest
+    from gtfs.feeds import FeedCache
+
+    class Handler(api.index.handler):
+        def __init__(self):
+            self.path = "/api/index.py?trace=1"
+            self.request_version = "HTTP/1.1"
+            self.requestline = "GET /api/index.py HTTP/1.1"
+            self.client_address = ("bench", 0)
+            self.wfile = io.BytesIO()
+
+        def log_message(self, *args):
+            pass
+
+    patches = {
+        "iter_reports": lambda priv_keys, since=None: in_batches(fetch_reports(priv_keys, since=since)),
+        "acquire": FakeConnection,
+        "release": lambda conn: None,
+    }
+    if states is not None:
+        patches["load_states"] = states.load_states
+        patches["save_states"] = states.save_states
+    saved = {name: getattr(api.index, name) for name in (*patches, "shared_feeds")}
+    saved_env = {name: os.environ.get(name) for name in ("BEACON_IDS", "BEACON_LINES")}
+    os.environ["BEACON_IDS"] = json.dumps(list(beacon_ids))
+    if line_for is not None:
+        lines = {}
+        for beacon_id in beacon_ids:
+            lines.setdefault(line_for(beacon_id), []).append(key_digest(beacon_id))
+        os.environ["BEACON_LINES"] = json.dumps(lines)
+
+    def run_once():
+        # A fresh feed cache per run: each run parses its feeds, as a cron invocation would
+        api.index.shared_feeds = FeedCache(fetch=fetch_feed)
+        handler = Handler()
+        with quiet():
+            start = time.perf_counter()
+            handler.do_GET()
+            elapsed = time.perf_counter() - start
+        body = handler.wfile.getvalue()
+        return elapsed, json.loads(body[body.index(b"\r\n\r\n") + 4:])
+
+    try:
+        for name, value in patches.items():
+            setattr(api.index, name, value)
+        yield run_once
+    finally:
+        for name, value in saved.items():
+            setattr(api.index, name, value)
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def count_statuses(response):
+    statuses = {}
+    for result in response.get("beacons", []):
+        statuses[result.get("status")] = statuses.get(result.get("status"), 0) + 1
+    return statuses
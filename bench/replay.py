@@ -0,0 +1,79 @@
+import statistics
+from bench.pipeline import MemoryStates, count_statuses, patched_index
+
+# Replays archived production runs (REPLAY_MODE=record, see gtfs/replay.py) through
+# /api/index.py, oldest first, with beacon state carried from one run to the next.
+
+
+def replay(archive, match_window=None, stop_radius=None):
+    """
+    Replay every run under archive; match_window / stop_radius override MATCH_WINDOW_SEC /
+    STOP_RADIUS for the replay. Returns a summary with one entry per run.
+    """
+    import api.index
+    import gtfs.replay
+    import gtfs.utils
+    from bench.fixtures import snapshot_from_bytes
+    from gtfs.replay import load_feed, load_reports, replaying, runs
+
+    run_dirs = runs(archive)
+    if not run_dirs:
+        raise SystemExit(f"No recorded runs under {archive}")
+
+    overrides = {(gtfs.replay, "REPLAY_MODE"): ""}  # never record the replay itself
+    if match_window is not None:
+        overrides[(gtfs.utils, "MATCH_WINDOW_SEC")] = match_window
+    if stop_radius is not None:
+        overrides[(gtfs.utils, "STOP_RADIUS")] = stop_radius
+        overrides[(api.index, "STOP_RADIUS")] = stop_radius
+    saved = {target: getattr(*target) for target in overrides}
+
+    states = MemoryStates()
+    last_feeds = {}  # a run that reused a cached feed archived none; use the last one seen
+    per_run, totals, beacons, errors, elapsed_total = [], {}, 0, 0, 0.0
+    try:
+        for (module, name), value in overrides.items():
+            setattr(module, name, value)
+
+        for run_dir in run_dirs:
+            reports = load_reports(run_dir)
+
+            def fetch_feed(line, run_dir=run_dir):
+                data = load_feed(run_dir, line) or last_feeds.get(line)
+                if data is None:
+                    raise RuntimeError(f"No archived {line} feed at or before {run_dir.name}")
+                last_feeds[line] = data
+                return snapshot_from_bytes(line, data)
+
+            beacon_ids = [key.private_key_b64 for key in reports]
+            with patched_index(lambda priv_keys, since=None: reports, fetch_feed, beacon_ids, states=states) as run_once:
+                with replaying(run_dir):
+                    elapsed, response = run_once()
+
+            statuses = count_statuses(response)
+            for status, count in statuses.items():
+                totals[status] = totals.get(status, 0) + count
+            beacons += len(beacon_ids)
+            errors += len(response.get("errors", []))
+            elapsed_total += elapsed
+            per_run.append({"run": run_dir.name, "ms": round(elapsed * 1000, 2), "statuses": statuses,
+                            "errors": len(response.get("errors", []))})
+    finally:
+        for (module, name), value in saved.items():
+            setattr(module, name, value)
+
+    return {
+        "runs": len(per_run),
+        "beacons": beacons,
+        "beacons_per_sec": round(beacons / elapsed_total, 1) if elapsed_total else None,
+        "run_ms_median": round(statistics.median(r["ms"] for r in per_run), 2),
+        "statuses": totals,
+        "errors": errors,
+        "per_run": per_run,
+    }
+
+
+def print_summary(summary):
+    print(f"Replayed {summary['runs']} runs ({summary['beacons']} beacon classifications): "
+          f"{summary['beacons_per_sec']} beacons/sec, median run {summary['run_ms_median']} ms")
+    print(f"   statuses {summary['statuses']}, errors {summary['errors']}")
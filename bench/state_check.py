@@ -0,0 +1,178 @@
+from datetime import datetime, timedelta, timezone
+from findmy import KeyPair
+from bench.pipeline import quiet
+from bench.synthetic import line_paths
+from gtfs import fetch_reports
+from gtfs.beacon_state import RESCAN_MIN, BeaconState
+from gtfs.lines import get_line
+from gtfs.reports import Report
+
+# Edge cases of the incremental fetch: late uploads before the high-water mark, a beacon with
+# no state yet, and the per-key report buffer once it is full. Each check returns the
+# failures it found; bench/__main__.py runs them all as "python -m bench check".
+
+LINE = "G"
+NOW = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+
+
+class FakeLocationReport:
+    """Just what _buffer_reports needs from a findmy LocationReport: payload, timestamp and its ordering."""
+
+    __slots__ = ("payload", "timestamp")
+
+    def __init__(self, payload, timestamp):
+        self.payload = payload
+        self.timestamp = timestamp
+
+    def __lt__(self, other):
+        return self.timestamp < other.timestamp
+
+
+def _ride(term_id, start, count, interval=timedelta(seconds=90), first_distance=2000):
+    """count reports riding away from term_id, the first first_distance meters out, starting at start."""
+    path = line_paths(LINE)[term_id]
+    reports = []
+    for i in range(count):
+        lat, lon = path.at(first_distance + 400 * i)
+        reports.append(Report("beacon", "hashed", start + i * interval, lat, lon))
+    return reports
+
+
+def _at_terminus(term_id, timestamp):
+    lat, lon = get_line(LINE).termini[term_id]
+    return Report("beacon", "hashed", timestamp, lat, lon)
+
+
+def check_late_terminus_upload():
+    """A terminus report uploaded after the mark moved past it is still picked up, once."""
+    failures = []
+    old_term, new_term = list(get_line(LINE).termini)[:2]
+    seen = _ride(old_term, NOW - timedelta(minutes=30), 20)
+    state = BeaconState("beacon", LINE, old_term, NOW - timedelta(hours=2), seen[-1].timestamp,
+                        direction="N", trip_id="trip-before")
+
+    late = _at_terminus(new_term, state.high_water_mark - timedelta(minutes=RESCAN_MIN // 2))
+    after = _ride(new_term, seen[-1].timestamp + timedelta(seconds=90), 3)
+    reports = sorted(seen + [late] + after, key=lambda r: r.timestamp)
+    with quiet():
+        new_reports = state.advance(reports)
+    if new_reports != after:
+        failures.append(f"late upload: advance returned {len(new_reports)} new reports, expected {len(after)}")
+    if (state.last_terminus_id, state.last_terminus_at) != (new_term, late.timestamp):
+        failures.append(f"late upload: terminus event not picked up, state is {state!r}")
+    if state.trip_id is not None:
+        failures.append("late upload: a new terminus event did not clear the matched trip")
+    if state.high_water_mark != after[-1].timestamp:
+        failures.append(f"late upload: high-water mark {state.high_water_mark}, expected {after[-1].timestamp}")
+
+    # The next run sees the same event in its rescan window; it must not start another trip
+    state.trip_id = "trip-after"
+    with quiet():
+        state.advance(reports + _ride(new_term, after[-1].timestamp + timedelta(seconds=90), 1, first_distance=4500))
+    if state.trip_id != "trip-after":
+        failures.append("late upload: the same terminus event cleared the matched trip again")
+
+    # A late upload further back than the rescan window is out of reach by design
+    stale = BeaconState("beacon", LINE, old_term, NOW - timedelta(hours=2), seen[-1].timestamp)
+    too_late = _at_terminus(new_term, stale.high_water_mark - timedelta(minutes=RESCAN_MIN + 5))
+    with quiet():
+        stale.advance(sorted(seen + [too_late], key=lambda r: r.timestamp))
+    if stale.last_terminus_id != old_term:
+        failures.append("late upload: a report older than the rescan window changed the terminus")
+    return failures
+
+
+def check_cold_state():
+    """With no high-water mark every report is new and all of them are scanned."""
+    failures = []
+    term_id = list(get_line(LINE).termini)[0]
+    empty = BeaconState("beacon", LINE)
+    with quiet():
+        if empty.advance([]) != [] or empty.high_water_mark is not None:
+            failures.append(f"cold state: advancing over no reports changed the state to {empty!r}")
+
+    reports = [_at_terminus(term_id, NOW - timedelta(minutes=40))] + _ride(term_id, NOW - timedelta(minutes=38), 10)
+    state = BeaconState("beacon", LINE)
+    with quiet():
+        new_reports = state.advance(reports)
+    if new_reports != reports:
+        failures.append(f"cold state: advance returned {len(new_reports)} of {len(reports)} reports")
+    if (state.last_terminus_id, state.last_terminus_at) != (term_id, reports[0].timestamp):
+        failures.append(f"cold state: terminus event not picked up, state is {state!r}")
+    if state.direction is None:
+        failures.append("cold state: no direction after a terminus event")
+    if state.high_water_mark != reports[-1].timestamp:
+        failures.append(f"cold state: high-water mark {state.high_water_mark}, expected {reports[-1].timestamp}")
+    return failures
+
+
+def check_buffer_merge():
+    """Out-of-order reports merged into a full buffer keep it sorted, deduplicated and at size."""
+    failures = []
+    size = fetch_reports.MAX_REPORTS_PER_KEY
+    key = KeyPair.new()
+    start = NOW - timedelta(minutes=2 * size)
+    # A full buffer of reports every other minute
+    full = [FakeLocationReport(f"p{i}".encode(), start + timedelta(minutes=2 * i)) for i in range(size)]
+    try:
+        fetch_reports._buffer_reports(key, full)
+        late = FakeLocationReport(b"late", full[size // 2].timestamp + timedelta(minutes=1))
+        too_old = FakeLocationReport(b"too-old", start - timedelta(minutes=1))
+        newest = FakeLocationReport(b"newest", full[-1].timestamp + timedelta(minutes=2))
+        buffered = fetch_reports._buffer_reports(key, [newest, full[-3], late, too_old])
+
+        timestamps = [report.timestamp for report in buffered]
+        payloads = [report.payload for report in buffered]
+        if len(buffered) != size:
+            failures.append(f"buffer merge: {len(buffered)} reports buffered, expected {size}")
+        if timestamps != sorted(timestamps):
+            failures.append("buffer merge: buffered reports are out of order")
+        if len(set(payloads)) != len(payloads):
+            failures.append("buffer merge: a refetched report was buffered twice")
+        if b"late" not in payloads or payloads[-1] != b"newest":
+            failures.append("buffer merge: a new report was lost")
+        if b"too-old" in payloads or b"p0" in payloads or b"p1" in payloads:
+            failures.append("buffer merge: the oldest reports were not the ones dropped")
+
+        # The next window starts an overlap before the newest buffered report
+        overlap = timedelta(minutes=fetch_reports.OVERLAP_MIN)
+        window = fetch_reports._window_start(key, None, NOW)
+        if window != newest.timestamp - overlap:
+            failures.append(f"window: {window} for a buffered key, expected {newest.timestamp - overlap}")
+    finally:
+        with fetch_reports._buffers_lock:
+            fetch_reports._buffers.pop(key, None)
+    return failures
+
+
+def check_window_start():
+    """Without a buffer the window starts at the persisted mark, else HISTORY_HOURS back, never past the full window."""
+    failures = []
+    key = KeyPair.new()
+    overlap = timedelta(minutes=fetch_reports.OVERLAP_MIN)
+    since = NOW - timedelta(hours=5)
+    expected = {
+        "persisted mark": (since, since - overlap),
+        "no state": (None, NOW - timedelta(hours=fetch_reports.HISTORY_HOURS)),
+        "mark past the full window": (NOW - timedelta(days=30), NOW - timedelta(hours=fetch_reports.FULL_WINDOW_HOURS)),
+    }
+    for case, (mark, start) in expected.items():
+        window = fetch_reports._window_start(key, mark, NOW)
+        if window != start:
+            failures.append(f"window: {window} with {case}, expected {start}")
+    return failures
+
+
+CHECKS = (check_late_terminus_upload, check_cold_state, check_buffer_merge, check_window_start)
+
+
+def run_checks(checks=CHECKS):
+    """Run each check; returns {check name: failures}."""
+    return {check.__name__: check() for check in checks}
+
+
+def print_checks(results):
+    for name, failures in results.items():
+        print(f"== {name}: {'ok' if not failures else f'{len(failures)} failed'}")
+        for failure in failures:
+            print(f"   {failure}")
@@ -0,0 +1,73 @@
+import itertools
+
+# Local stand-ins for Postgres and the Find My fetch, so the index handler runs without a network.
+
+
+class FakeCursor:
+    """
+    Accepts what the handler sends and returns plausible results: ids for INSERT ... RETURNING id,
+    one row per inserted value for RETURNING 1, and no saved rows for SELECTs.
+    Rows are still rendered (mogrify) so execute_values does its real work.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = 0
+        self._rows = []
+        self._mogrified = 0
+
+    def mogrify(self, template, args):
+        self._mogrified += 1
+        return repr(args).encode()
+
+    def execute(self, query, args=None):
+        self.statements += 1
+        text = query.decode() if isinstance(query, bytes) else str(query)
+        if "RETURNING id" in text:
+            self._rows = [(next(self._ids),)]
+        elif "RETURNING 1" in text:
+            self._rows = [(1,)] * self._mogrified
+        else:
+            self._rows = []
+        self._mogrified = 0
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeConnection:
+    encoding = "UTF8"
+    closed = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def fake_fetch_reports(beacons):
+    """A fetch_reports replacement returning each synthetic beacon's history, keyed by KeyPair."""
+    reports = {beacon.key: beacon.reports for beacon in beacons}
+
+    def fetch_reports(priv_keys, since=None):
+        return reports
+
+    return fetch_reports
@@ -0,0 +1,117 @@
+import math
+import random
+from datetime import datetime, timedelta, timezone
+from findmy import KeyPair
+from gtfs.lines import get_line
+from gtfs.utils import haversine_distance, load_shapes
+
+# Synthetic beacon histories: each beacon waits at a terminus, then rides the line's longest
+# shape away from it at subway speed, reporting every REPORT_INTERVAL. Beacons ride trains that
+# leave each terminus every HEADWAY, so several beacons can share a train.
+
+SPEED = 8.0  # m/s, a typical average including dwell times
+REPORT_INTERVAL = timedelta(seconds=90)
+DWELL = timedelta(minutes=4)
+HISTORY = timedelta(hours=2)
+# Well over the ±4 minute match window, so a beacon can only match its own train
+HEADWAY = timedelta(minutes=10)
+
+
+class FakeKeyReport:
+    """Just the KeyReport attributes decode_reports reads."""
+
+    __slots__ = ("is_decrypted", "hashed_adv_key_b64", "timestamp", "latitude", "longitude")
+
+    def __init__(self, hashed_adv_key_b64, timestamp, latitude, longitude):
+        self.is_decrypted = True
+        self.hashed_adv_key_b64 = hashed_adv_key_b64
+        self.timestamp = timestamp
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+class Path:
+    """A shape polyline with cumulative distances, for positions at a distance along it."""
+
+    def __init__(self, points):
+        self.points = points
+        self.chainage = [0.0]
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            self.chainage.append(self.chainage[-1] + haversine_distance(lat1, lon1, lat2, lon2))
+        self.length = self.chainage[-1]
+
+    def at(self, distance):
+        distance = min(max(distance, 0.0), self.length)
+        lo, hi = 0, len(self.chainage) - 1
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.chainage[mid] <= distance:
+                lo = mid
+            else:
+                hi = mid
+        span = self.chainage[hi] - self.chainage[lo]
+        t = (distance - self.chainage[lo]) / span if span else 0.0
+        (lat1, lon1), (lat2, lon2) = self.points[lo], self.points[hi]
+        return lat1 + t * (lat2 - lat1), lon1 + t * (lon2 - lon1)
+
+
+def line_paths(line):
+    """{terminus_id: Path leaving that terminus} from the line's longest shape."""
+    by_shape = {}
+    for pt in load_shapes(line):
+        by_shape.setdefault(pt["shape_id"], []).append(pt)
+    longest = max(by_shape.values(), key=len)
+    longest.sort(key=lambda p: p["shape_pt_sequence"])
+    points = [(p["lat"], p["lon"]) for p in longest]
+
+    paths = {}
+    for term_id, (lat, lon) in get_line(line).termini.items():
+        start = haversine_distance(lat, lon, *points[0])
+        end = haversine_distance(lat, lon, *points[-1])
+        paths[term_id] = Path(points if start <= end else points[::-1])
+    return paths
+
+
+class SyntheticBeacon:
+    """A beacon's key, line and the terminus departure a feed trip can be matched against."""
+
+    def __init__(self, key, line, terminus_id, departed_at, reports):
+        self.key = key
+        self.line = line
+        self.terminus_id = terminus_id
+        self.departed_at = departed_at
+        self.reports = reports
+
+    @property
+    def beacon_id(self):
+        return self.key.private_key_b64
+
+
+def make_beacons(count, lines=("G", "C"), now=None, seed=0):
+    """count beacons spread over lines, each with HISTORY worth of reports ending at now."""
+    rng = random.Random(seed)
+    now = now or datetime.now(timezone.utc)
+    paths = {line: line_paths(line) for line in lines}
+    beacons = []
+    for i in range(count):
+        line = lines[i % len(lines)]
+        term_id = rng.choice(sorted(paths[line]))
+        path = paths[line][term_id]
+        trains = max(1, int((path.length / SPEED - 60) // HEADWAY.total_seconds()) + 1)
+        departed_at = now - timedelta(seconds=60) - HEADWAY * rng.randrange(trains)
+        hashed = f"synthetic-{i}"
+
+        reports = []
+        ts = now - HISTORY + timedelta(seconds=rng.uniform(0, REPORT_INTERVAL.total_seconds()))
+        while ts <= now:
+            if ts < departed_at - DWELL:
+                # Arriving from the other end
+                distance = SPEED * (departed_at - DWELL - ts).total_seconds()
+            else:
+                distance = SPEED * max((ts - departed_at).total_seconds(), 0.0)
+            lat, lon = path.at(distance)
+            jitter = rng.gauss(0, 15) / 111_000  # ~15 m of location noise
+            reports.append(FakeKeyReport(hashed, ts, lat + jitter, lon + jitter / math.cos(math.radians(lat))))
+            ts += REPORT_INTERVAL
+        beacons.append(SyntheticBeacon(KeyPair.new(), line, term_id, departed_at, reports))
+    return beacons
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from functools import lru_cache
+import requests
+
+# Encrypted Apple account session state.
+#
+# Lookup order is: in-process copy -> local encrypted file -> blob storage. The local file
+# and in-process copy are trusted for LOCAL_MAX_AGE_SEC; after that the blob is checked again
+# (a cheap HEAD when it has not changed). Blob storage is only written when the state changed.
+
+BLOB_PATH   = "account.json"
+BLOB_BASE_URL   = os.getenv("VERCEL_BLOB_STORE_URL")
+BLOB_URL    = f"{BLOB_BASE_URL}/{BLOB_PATH}"
+# The cipher key (BLOB_KEY) and the blob client are only loaded when the state is read or written.
+
+LOCAL_PATH = Path(os.environ.get("ACCOUNT_CACHE_PATH", "/tmp/account.json.enc"))
+LOCAL_MAX_AGE_SEC = int(os.environ.get("ACCOUNT_CACHE_MAX_AGE_SEC", "900"))
+# Sessions older than this are re-established by refresh_session(), off the request path.
+REFRESH_AFTER_SEC = int(os.environ.get("ACCOUNT_REFRESH_AFTER_SEC", str(12 * 60 * 60)))
+
+_cached = None  # {"state", "digest", "saved_at", "uploaded_at", "checked_at"}
+
+@lru_cache(maxsize=None)
+def _cipher():
+    """The Fernet cipher for BLOB_KEY, built on first use rather than at import."""
+    from cryptography.fernet import Fernet
+    return Fernet(os.environ["BLOB_KEY"].encode())
+
+def _encrypt_json(obj: dict) -> bytes:
+    return _cipher().encrypt(json.dumps(obj, separators=(",", ":")).encode())
+
+def _decrypt_json(blob: bytes) -> dict:
+    from cryptography.fernet import InvalidToken
+    try:
+        return json.loads(_cipher().decrypt(blob))
+    except InvalidToken:
+        raise ValueError("The blob could not be decrypted (wrong key or tampered data).")
+
+def _upload_json(path: str, data: dict) -> None:
+    import vercel_blob
+    vercel_blob.put(
+        path,
+        _encrypt_json(data),
+        {
+            "contentType": "application/octet-stream",
+            "allowOverwrite": "true"
+        }
+    )
+
+def _digest(state: dict) -> str:
+    return hashlib.sha256(json.dumps(state, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def _unwrap(data: dict) -> tuple[dict, float]:
+    """Blobs written before saved_at was tracked hold the bare account state."""
+    if "state" in data and "saved_at" in data:
+        return data["state"], data["saved_at"]
+    return data, 0.0
+
+def _remember(state: dict, saved_at: float, uploaded_at: str | None) -> dict:
+    global _cached
+    _cached = {
+        "state": state,
+        "digest": _digest(state),
+        "saved_at": saved_at,
+        "uploaded_at": uploaded_at,
+        "checked_at": time.time(),
+    }
+    try:
+        LOCAL_PATH.write_bytes(_encrypt_json(_cached))
+    except OSError as e:
+        print(f"Could not write local account cache {LOCAL_PATH}: {e}")
+    return state
+
+def _read_local() -> dict | None:
+    try:
+        return _decrypt_json(LOCAL_PATH.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+def load_state() -> dict:
+    """Return the saved account state from the freshest cache level that has it."""
+    global _cached
+    if _cached is None:
+        _cached = _read_local()
+    if _cached is not None and time.time() - _cached["checked_at"] <= LOCAL_MAX_AGE_SEC:
+        return _cached["state"]
+
+    import vercel_blob
+    meta = vercel_blob.head(BLOB_URL)                     # cheap HEAD call
+    if _cached is not None and meta.get("uploadedAt") == _cached["uploaded_at"]:
+        # Blob unchanged since we last downloaded it; keep the local copy.
+        return _remember(_cached["state"], _cached["saved_at"], _cached["uploaded_at"])
+
+    blob = requests.get(meta["downloadUrl"], timeout=10).content
+    state, saved_at = _unwrap(_decrypt_json(blob))
+    return _remember(state, saved_at, meta.get("uploadedAt"))
+
+def save_state(state: dict, refreshed: bool = False) -> bool:
+    """
+    Persist the account state. Blob storage is only written when the state differs
+    from what was loaded (or when refreshed=True marks a newly established session).
+    Returns True if the blob was written.
+    """
+    if not refreshed and _cached is not None and _digest(state) == _cached["digest"]:
+        return False
+
+    saved_at = time.time() if refreshed or _cached is None else _cached["saved_at"]
+    _upload_json(BLOB_PATH, {"state": state, "saved_at": saved_at})
+    _remember(state, saved_at, None)
+    return True
+
+def needs_refresh() -> bool:
+    """True if there is no saved session or it is older than REFRESH_AFTER_SEC."""
+    return _cached is None or time.time() - _cached["saved_at"] > REFRESH_AFTER_SEC
@@ -0,0 +1,110 @@
+import os
+from datetime import timedelta, timezone
+from psycopg2.extras import execute_values
+from gtfs.db import to_db_timestamp
+from gtfs.utils import get_last_terminus_report, get_direction_from_terminus
+
+# What the index handler remembers about each beacon between runs, so a run only has
+# to look at reports newer than the last one it processed.
+# Timestamps are stored without a time zone, in UTC.
+
+# Reports can be uploaded after newer ones. The report fetch asks again for this much before the
+# high-water mark (gtfs/fetch_reports.py), and that overlap is scanned again for a terminus event.
+RESCAN_MIN = int(os.environ.get("REPORT_OVERLAP_MIN", "15"))
+
+SELECT_STATES = """
+SELECT "beaconId", line, "lastTerminusId", "lastTerminusAt", "highWaterMark", direction, "tripId"
+FROM "BeaconState"
+WHERE "beaconId" = ANY(%s)
+"""
+
+UPSERT_STATES = """
+INSERT INTO "BeaconState" ("beaconId", line, "lastTerminusId", "lastTerminusAt", "highWaterMark", direction, "tripId", "updatedAt")
+VALUES %s
+ON CONFLICT ("beaconId") DO UPDATE SET
+    line = EXCLUDED.line,
+    "lastTerminusId" = EXCLUDED."lastTerminusId",
+    "lastTerminusAt" = EXCLUDED."lastTerminusAt",
+    "highWaterMark" = EXCLUDED."highWaterMark",
+    direction = EXCLUDED.direction,
+    "tripId" = EXCLUDED."tripId",
+    "updatedAt" = EXCLUDED."updatedAt"
+"""
+
+def _from_db(ts):
+    return ts.replace(tzinfo=timezone.utc) if ts else None
+
+
+class BeaconState:
+    """The last terminus event, direction and matched trip of one beacon."""
+
+    __slots__ = ("beacon_id", "line", "last_terminus_id", "last_terminus_at", "high_water_mark", "direction", "trip_id")
+
+    def __init__(self, beacon_id, line, last_terminus_id=None, last_terminus_at=None,
+                 high_water_mark=None, direction=None, trip_id=None):
+        self.beacon_id = beacon_id
+        self.line = line
+        self.last_terminus_id = last_terminus_id
+        self.last_terminus_at = last_terminus_at
+        self.high_water_mark = high_water_mark
+        self.direction = direction
+        self.trip_id = trip_id
+
+    def __repr__(self):
+        # beacon_id is the beacon's private key, so it is left out.
+        return (f"BeaconState(line={self.line}, terminus={self.last_terminus_id} at {self.last_terminus_at}, "
+                f"direction={self.direction}, trip={self.trip_id}, seen_until={self.high_water_mark})")
+
+    def advance(self, reports):
+        """
+        Fold reports (oldest first) newer than the high-water mark into the state and
+        return them. Those reports, and the last RESCAN_MIN before the mark (where late
+        uploads land), are scanned for a terminus event. An event newer than the known one
+        starts a new trip, so the direction is recomputed and the matched trip cleared.
+        """
+        start = len(reports)
+        while start > 0 and (self.high_water_mark is None or reports[start - 1].timestamp > self.high_water_mark):
+            start -= 1
+        new_reports = reports[start:]
+
+        rescan_from = self.high_water_mark - timedelta(minutes=RESCAN_MIN) if self.high_water_mark else None
+        while start > 0 and reports[start - 1].timestamp > rescan_from:
+            start -= 1
+        event = get_last_terminus_report(reports[start:], self.line) if start < len(reports) else None
+        if event and (self.last_terminus_at is None or event[0].timestamp > self.last_terminus_at):
+            term_report, term_id = event
+            self.last_terminus_id = term_id
+            self.last_terminus_at = term_report.timestamp
+            self.direction = get_direction_from_terminus(term_id, self.line)
+            self.trip_id = None
+        if new_reports:
+            self.high_water_mark = new_reports[-1].timestamp
+        return new_reports
+
+    def as_row(self, updated_at):
+        """Column values for an upsert into "BeaconState"."""
+        return (self.beacon_id, self.line, self.last_terminus_id, to_db_timestamp(self.last_terminus_at),
+                to_db_timestamp(self.high_water_mark), self.direction, self.trip_id, to_db_timestamp(updated_at))
+
+
+def load_states(cur, beacon_lines):
+    """
+    Load the saved state of each beacon in beacon_lines (beacon id -> line).
+    Beacons without saved state, or whose line changed, start from a fresh state.
+    """
+    states = {beacon_id: BeaconState(beacon_id, line) for beacon_id, line in beacon_lines.items()}
+    if not states:
+        return states
+    cur.execute(SELECT_STATES, (list(states),))
+    for beacon_id, line, term_id, term_at, high_water_mark, direction, trip_id in cur.fetchall():
+        if states[beacon_id].line != line:
+            continue
+        states[beacon_id] = BeaconState(beacon_id, line, term_id, _from_db(term_at),
+                                        _from_db(high_water_mark), direction, trip_id)
+    return states
+
+def save_states(cur, states, updated_at):
+    """Upsert BeaconState records in one statement."""
+    rows = [state.as_row(updated_at) for state in states]
+    if rows:
+        execute_values(cur, UPSERT_STATES, rows)
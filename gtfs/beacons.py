@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+# The beacons the index handler tracks. BEACON_IDS (a JSON list of private keys, base64)
+# says which beacons there are; the line each one rides is looked up by the SHA-256 of its
+# private key in BEACON_LINES (JSON, {line: [digests]}) or, if that is unset,
+# gtfs/beacon_lines.json. Key objects are derived once per process and shared by the
+# report fetch and the classification of each run.
+
+BEACON_LINES_PATH = Path(__file__).with_name("beacon_lines.json")
+
+
+class Beacon:
+    """One tracked beacon: its findmy KeyPair, line and identifiers."""
+
+    __slots__ = ("beacon_id", "key", "line", "digest", "hashed_adv_key")
+
+    def __init__(self, beacon_id, key, line, digest, hashed_adv_key):
+        self.beacon_id = beacon_id  # the private key (base64), as stored in the database
+        self.key = key
+        self.line = line
+        self.digest = digest  # SHA-256 of the private key; safe to log
+        self.hashed_adv_key = hashed_adv_key
+
+    def __repr__(self):
+        # beacon_id is the beacon's private key, so it is left out.
+        return f"Beacon(line={self.line}, digest={self.digest[:12]})"
+
+
+def key_digest(beacon_id):
+    return hashlib.sha256(beacon_id.encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _line_by_digest(lines_json):
+    lines = json.loads(lines_json) if lines_json else json.loads(BEACON_LINES_PATH.read_text())
+    return {digest: line for line, digests in lines.items() for digest in digests}
+
+
+def line_for_beacon(beacon_id):
+    """The line a beacon rides, or "unknown" if its key is not assigned to one."""
+    by_digest = _line_by_digest(os.environ.get("BEACON_LINES", ""))
+    return by_digest.get(key_digest(beacon_id), "unknown")
+
+
+@lru_cache(maxsize=8)
+def _load(beacon_ids_json, lines_json):
+    from findmy import KeyPair
+
+    by_digest = _line_by_digest(lines_json)
+    beacons, invalid = {}, []
+    for beacon_id in json.loads(beacon_ids_json):
+        digest = key_digest(beacon_id)
+        try:
+            key = KeyPair.from_b64(beacon_id)
+        except Exception as e:
+            # One malformed key only takes out its own beacon
+            print(f"Invalid beacon key {digest[:12]}: {e}")
+            invalid.append({"beaconId": beacon_id, "error": f"Invalid beacon key: {e}"})
+            continue
+        beacons[beacon_id] = Beacon(beacon_id, key, by_digest.get(digest, "unknown"), digest, key.hashed_adv_key_b64)
+    return beacons, invalid
+
+
+def load_beacons():
+    """
+    ({beacon id: Beacon}, [error for each malformed key]) for BEACON_IDS, in order. Built
+    once per process (and again only if BEACON_IDS or BEACON_LINES change), so no key is
+    derived on the request path.
+    """
+    return _load(os.environ.get("BEACON_IDS", "[]"), os.environ.get("BEACON_LINES", ""))
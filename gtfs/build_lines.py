@@ -0,0 +1,105 @@
+"""
+Compile the line registry (gtfs/lines.json) into gtfs/lines.npz.
+
+    python -m gtfs.build_lines           # rebuild the artifact
+    python -m gtfs.build_lines --check   # exit 1 if it is out of date with its sources
+
+lines.json lists, per line, the realtime feed it is published in, its shape file and its
+stations from north terminus to south terminus. Everything else comes from the shared data: stop names and coordinates (stations
+and their N/S platforms) from gtfs/stops.txt, shape points from the shape file. Termini
+and the direction-suffixed expected termini are the ends of the station list, so adding a
+line means adding its entry and shape file, then rebuilding.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import sys
+from pathlib import Path
+import numpy as np
+from gtfs.feeds import MTA_FEEDS
+from gtfs.lines import ARTIFACT_PATH
+
+GTFS_DIR = Path(__file__).parent
+SPEC_PATH = GTFS_DIR / "lines.json"
+STOPS_PATH = GTFS_DIR / "stops.txt"
+
+
+def _sources(spec):
+    return [SPEC_PATH, STOPS_PATH, *(GTFS_DIR / entry["shapes"] for entry in spec.values())]
+
+
+def source_digest(spec):
+    """SHA-256 over every input file, stored in the artifact to detect a stale build."""
+    digest = hashlib.sha256()
+    for path in _sources(spec):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def compile_lines():
+    """Build the registry arrays from the sources: {array name: numpy array}."""
+    spec = json.loads(SPEC_PATH.read_text())
+    with open(STOPS_PATH, newline="") as f:
+        all_stops = list(csv.DictReader(f))
+    known = {row["stop_id"] for row in all_stops}
+
+    arrays = {"lines": np.array(list(spec), dtype=str), "source_digest": np.array(source_digest(spec))}
+    for line, entry in spec.items():
+        sequence = entry["stops"]
+        stations = set(sequence)
+        missing = [stop_id for stop_id in sequence if stop_id not in known]
+        if missing:
+            raise ValueError(f"{line}: stops not in {STOPS_PATH.name}: {missing}")
+        if entry["feed"] not in MTA_FEEDS:
+            raise ValueError(f"{line}: unknown feed {entry['feed']!r}; one of {', '.join(MTA_FEEDS)}")
+
+        # Stations and their platforms, in stops.txt order (parents before their N/S platforms)
+        stops = [row for row in all_stops if row["stop_id"] in stations or row["parent_station"] in stations]
+        arrays[f"{line}.feed"] = np.array(entry["feed"])
+        arrays[f"{line}.sequence"] = np.array(sequence, dtype=str)
+        arrays[f"{line}.stop_id"] = np.array([row["stop_id"] for row in stops], dtype=str)
+        arrays[f"{line}.stop_name"] = np.array([row["stop_name"] for row in stops], dtype=str)
+        arrays[f"{line}.stop_lat"] = np.array([float(row["stop_lat"]) for row in stops])
+        arrays[f"{line}.stop_lon"] = np.array([float(row["stop_lon"]) for row in stops])
+
+        with open(GTFS_DIR / entry["shapes"], newline="") as f:
+            points = list(csv.DictReader(f))
+        arrays[f"{line}.shape_id"] = np.array([row["shape_id"] for row in points], dtype=str)
+        arrays[f"{line}.shape_seq"] = np.array([int(row["shape_pt_sequence"]) for row in points], dtype=np.int32)
+        arrays[f"{line}.shape_lat"] = np.array([float(row["shape_pt_lat"]) for row in points])
+        arrays[f"{line}.shape_lon"] = np.array([float(row["shape_pt_lon"]) for row in points])
+    return arrays
+
+
+def is_stale(path=ARTIFACT_PATH):
+    if not path.exists():
+        return True
+    spec = json.loads(SPEC_PATH.read_text())
+    with np.load(path, allow_pickle=False) as artifact:
+        return str(artifact["source_digest"]) != source_digest(spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m gtfs.build_lines", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="only check that the artifact is up to date")
+    args = parser.parse_args()
+
+    if args.check:
+        if is_stale():
+            print(f"{ARTIFACT_PATH} is out of date; run python -m gtfs.build_lines")
+            return 1
+        print(f"{ARTIFACT_PATH} is up to date")
+        return 0
+
+    arrays = compile_lines()
+    # Uncompressed, so loading is a plain read of each array
+    np.savez(ARTIFACT_PATH, **arrays)
+    print(f"Wrote {ARTIFACT_PATH} ({ARTIFACT_PATH.stat().st_size} bytes): lines {', '.join(arrays['lines'])}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timezone
+import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+POOL_MIN = int(os.environ.get("PG_POOL_MIN", "1"))
+POOL_MAX = int(os.environ.get("PG_POOL_MAX", "4"))
+# Connections idle for longer than this are pinged before reuse (Neon drops idle connections).
+PING_AFTER_IDLE_SEC = 60
+
+_pool = None
+_pool_lock = threading.Lock()
+_last_used = {}  # id(conn) -> time the connection was last released
+
+def to_db_timestamp(ts):
+    """ts as the naive UTC datetime the TIMESTAMP(3) columns hold (None stays None)."""
+    return ts.astimezone(timezone.utc).replace(tzinfo=None) if ts else None
+
+def get_pool():
+    """The process-wide connection pool, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = ThreadedConnectionPool(
+                POOL_MIN,
+                POOL_MAX,
+                host=os.environ.get("PGHOST"),
+                database=os.environ.get("PGDATABASE"),
+                user=os.environ.get("PGUSER"),
+                password=os.environ.get("PGPASSWORD"),
+                keepalives=1,
+                keepalives_idle=30,
+            )
+        return _pool
+
+def _is_alive(conn):
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < PING_AFTER_IDLE_SEC:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+def acquire():
+    """Borrow a connection from the pool, replacing it if the server has closed it."""
+    pool = get_pool()
+    conn = pool.getconn()
+    if not _is_alive(conn):
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release(conn):
+    """Return a borrowed connection; any open transaction is rolled back."""
+    if not conn.closed:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+    _last_used[id(conn)] = time.monotonic()
+    get_pool().putconn(conn, close=bool(conn.closed))
+
+@contextmanager
+def connection():
+    conn = acquire()
+    try:
+        yield conn
+    finally:
+        release(conn)
+
+INSERT_REPORTS = """
+INSERT INTO "BeaconReport" ("fetchId", "beaconId", "hashedAdvKey", timestamp, latitude, longitude)
+VALUES %s
+ON CONFLICT ("beaconId", "hashedAdvKey", timestamp) DO NOTHING
+RETURNING 1
+"""
+
+INSERT_TRIP_MAPPINGS = """
+INSERT INTO "BeaconTripMapping" ("fetchId", "tripId", "beaconId", "latestBeaconReport")
+VALUES %s
+"""
+
+# One row per beacon with its latest classification, read by /api/rideid. The trip and
+# latestBeaconReport columns keep the last match when a run does not match the beacon.
+UPSERT_STATUSES = """
+INSERT INTO "BeaconStatus" ("beaconId", line, status, reason, latitude, longitude, "reportedAt",
+                            "tripId", "latestBeaconReport", "nextStopId", "nextStopName", "updatedAt")
+VALUES %s
+ON CONFLICT ("beaconId") DO UPDATE SET
+    line = EXCLUDED.line,
+    status = EXCLUDED.status,
+    reason = EXCLUDED.reason,
+    latitude = EXCLUDED.latitude,
+    longitude = EXCLUDED.longitude,
+    "reportedAt" = EXCLUDED."reportedAt",
+    "tripId" = COALESCE(EXCLUDED."tripId", "BeaconStatus"."tripId"),
+    "latestBeaconReport" = COALESCE(EXCLUDED."latestBeaconReport", "BeaconStatus"."latestBeaconReport"),
+    "nextStopId" = EXCLUDED."nextStopId",
+    "nextStopName" = EXCLUDED."nextStopName",
+    "updatedAt" = EXCLUDED."updatedAt"
+"""
+
+def insert_reports(cur, fetch_id, reports, page_size=1000):
+    """
+    Insert Report records in as few statements as possible, skipping reports that
+    are already stored (same beacon, hashed key and timestamp).
+    Returns the number of new rows.
+    """
+    rows = [r.as_row(fetch_id) for r in reports]
+    if not rows:
+        return 0
+    return len(execute_values(cur, INSERT_REPORTS, rows, page_size=page_size, fetch=True))
+
+def insert_trip_mappings(cur, mappings):
+    """Insert (fetchId, tripId, beaconId, latestBeaconReport) tuples."""
+    if mappings:
+        execute_values(cur, INSERT_TRIP_MAPPINGS, mappings)
+
+def upsert_statuses(cur, statuses):
+    """
+    Upsert (beaconId, line, status, reason, latitude, longitude, reportedAt, tripId,
+    latestBeaconReport, nextStopId, nextStopName, updatedAt) tuples into "BeaconStatus".
+    """
+    if statuses:
+        execute_values(cur, UPSERT_STATUSES, statuses)
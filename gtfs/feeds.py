@@ -0,0 +1,153 @@
+import bisect
+import os
+import threading
+import time
+from gtfs.tracing import span
+from gtfs.replay import capture_feed
+
+# How long (seconds) a fetched feed is reused by a long-lived process before it is fetched again.
+FEED_TTL_SEC = int(os.environ.get("FEED_TTL_SEC", "30"))
+
+MTA_FEED_BASE = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/"
+
+# Every subway feed, by name; the line registry (gtfs/lines.json) says which feed each line is in
+MTA_FEEDS = {
+    "1234567S": "nyct%2Fgtfs",
+    "ACE": "nyct%2Fgtfs-ace",
+    "BDFM": "nyct%2Fgtfs-bdfm",
+    "G": "nyct%2Fgtfs-g",
+    "JZ": "nyct%2Fgtfs-jz",
+    "NQRW": "nyct%2Fgtfs-nqrw",
+    "L": "nyct%2Fgtfs-l",
+    "SIR": "nyct%2Fgtfs-si",
+}
+
+
+class FeedSnapshot:
+    """
+    A single fetch of a line's GTFS-realtime feed. The parsed trip list is built
+    once and shared by every beacon (and every matching strategy) that reads it.
+    """
+
+    def __init__(self, line, feed, fetched_at=None):
+        self.line = line
+        self.feed = feed
+        self.fetched_at = fetched_at if fetched_at is not None else time.monotonic()
+        self._departures = {}  # (line, headed_for_stop_id) -> (departure times, trips), sorted
+        self._departures_lock = threading.Lock()
+        self._trips = None
+        self._trips_lock = threading.Lock()
+
+    @property
+    def trips(self):
+        # Built under the lock so beacons classified in parallel share one trip list
+        with self._trips_lock:
+            if self._trips is None:
+                self._trips = self.feed.trips
+            return self._trips
+
+    def filter_trips(self, line_id=None, headed_for_stop_id=None, underway=None):
+        """Same semantics as NYCTFeed.filter_trips for the filters we use, without rebuilding the trip list."""
+        if isinstance(line_id, str):
+            line_id = [line_id]
+        trains = []
+        for train in self.trips:
+            if line_id is not None and train.route_id not in line_id:
+                continue
+            if underway is not None and train.underway != underway:
+                continue
+            if headed_for_stop_id is not None and not train.headed_to_stop(headed_for_stop_id):
+                continue
+            trains.append(train)
+        return trains
+
+    def departures(self, line, headed_for_stop_id):
+        """
+        Underway trips on the line headed for the stop, as parallel lists of departure
+        times and trips sorted by departure time. Built once per key per snapshot.
+        """
+        key = (line, headed_for_stop_id)
+        with self._departures_lock:
+            entry = self._departures.get(key)
+            if entry is None:
+                trains = self.filter_trips(line_id=[line], headed_for_stop_id=headed_for_stop_id, underway=True)
+                pairs = sorted(((train.departure_time, train) for train in trains), key=lambda p: p[0])
+                entry = ([t for t, _ in pairs], [train for _, train in pairs])
+                self._departures[key] = entry
+            return entry
+
+    def nearest_departure(self, line, headed_for_stop_id, when, window_sec):
+        """
+        Return (trip, seconds off) for the underway trip whose departure_time is closest
+        to when (naive Eastern), or (None, None) if none departed within window_sec of it.
+        """
+        times, trains = self.departures(line, headed_for_stop_id)
+        i = bisect.bisect_left(times, when)
+        best, best_diff = None, None
+        for j in (i - 1, i):
+            if 0 <= j < len(times):
+                diff = abs((times[j] - when).total_seconds())
+                if diff <= window_sec and (best_diff is None or diff < best_diff):
+                    best, best_diff = trains[j], diff
+        return best, best_diff
+
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+
+def feed_url(line):
+    """URL of the realtime feed the line is published in."""
+    from gtfs.lines import get_line
+
+    spec = get_line(line)
+    if spec is None:
+        raise ValueError(f"Unsupported line: {line}")
+    return MTA_FEED_BASE + MTA_FEEDS[spec.feed]
+
+
+def fetch_feed(line):
+    """Fetch and parse the realtime feed for the specified line."""
+    # Imported here so that loading this module (and the handlers that use it) stays cheap
+    import requests
+    from nyct_gtfs import NYCTFeed
+
+    print(f"Loading GTFS feed for {line} trains...")
+    with span("feed_load"):
+        # Same request NYCTFeed.refresh() makes, but keeping the raw bytes so they can be archived
+        feed = NYCTFeed(line, fetch_immediately=False)
+        response = requests.get(feed_url(line), timeout=10)
+        if response.status_code != 200:
+            raise RuntimeError(f"Error accessing MTA data feed: {response.content}")
+        capture_feed(line, response.content)
+        feed.load_gtfs_bytes(response.content)
+        return FeedSnapshot(line, feed)
+
+
+class FeedCache:
+    """
+    Feed snapshots keyed by line. A snapshot is reused until it is older than
+    ttl seconds; with ttl=None it is kept for the lifetime of the cache (e.g. one cron run).
+    """
+
+    def __init__(self, ttl=None, fetch=fetch_feed):
+        self.ttl = ttl
+        self.fetch = fetch
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def get(self, line):
+        with self._lock:
+            snapshot = self._snapshots.get(line)
+            if snapshot is None or (self.ttl is not None and snapshot.age() > self.ttl):
+                snapshot = self.fetch(line)
+                self._snapshots[line] = snapshot
+            return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+# Process-wide cache, so warm serverless instances and long-running servers reuse recent fetches.
+shared_feeds = FeedCache(ttl=FEED_TTL_SEC)
+
@@ -1,8 +1,15 @@
-import logging
+import asyncio
+import base64
+import contextvars
+import heapq
+import queue
 import sys
 import os
+import threading
+from collections import deque
 from findmy import KeyPair
 from findmy.reports import RemoteAnisetteProvider
+from findmy.reports.reports import LocationReport
 from collections.abc import MutableSequence
 import re
 import time
@@ -11,19 +18,41 @@ import email.utils
 import requests
 import typing
 from requests.auth import HTTPBasicAuth
-import vercel_blob
-from cryptography.fernet import Fernet, InvalidToken
+from gtfs.account_store import load_state, save_state, needs_refresh
+from gtfs.tracing import configure_logging, span
+from gtfs.replay import capture_reports, is_recording
 
 # URL to (public or local) anisette server
 ANISETTE_SERVER = os.environ.get("ANISETTE_SERVER")
 # ANISETTE_SERVER = "https://ani.sidestore.io/"
 
-logging.basicConfig(level=logging.INFO)
+# "async" fetches all keys concurrently, "sync" fetches them one at a time
+FETCH_MODE = os.environ.get("REPORT_FETCH_MODE", "async")
+FETCH_CONCURRENCY = int(os.environ.get("REPORT_FETCH_CONCURRENCY", "4"))  # max upstream queries in flight
+FETCH_BATCH_SIZE = int(os.environ.get("REPORT_FETCH_BATCH_SIZE", "16"))  # keys per upstream query
+MAX_REPORTS_PER_KEY = 200
+MAX_KEYS_PER_QUERY = 256  # what one report query takes (findmy splits larger key lists the same way)
+STREAM_QUEUE_SIZE = int(os.environ.get("REPORT_STREAM_QUEUE_SIZE", "2"))  # fetched batches waiting to be processed
+
+# "incremental" keeps only reports newer than what each beacon already has (buffered here, or
+# persisted as its BeaconState high-water mark); "last" keeps the whole last FULL_WINDOW_HOURS.
+# Either way every query downloads a week of reports: Apple does not honour a query's time range
+# (findmy 0.7.6 always asks for now-7d12h..now+12h and filters the response). Incremental mode
+# saves the decryption, sorting and buffering of the reports it drops, not the download.
+FETCH_WINDOW = os.environ.get("REPORT_FETCH_WINDOW", "incremental")
+FULL_WINDOW_HOURS = 168  # fetch_last_reports' window; also the furthest back incremental ever looks
+HISTORY_HOURS = int(os.environ.get("REPORT_HISTORY_HOURS", "2"))  # history fetched for a beacon never seen before
+OVERLAP_MIN = int(os.environ.get("REPORT_OVERLAP_MIN", "15"))  # reports can be uploaded after newer ones
+
+# Per-process ring buffer of each beacon's latest reports (oldest first, at most
+# MAX_REPORTS_PER_KEY), so a warm instance only decrypts and merges what is new.
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+_DONE = object()  # end of the report stream
 
 # ruff: noqa: ASYNC230
 
-import json
-from pathlib import Path
 import os
 
 from findmy.reports import (
@@ -32,42 +61,10 @@ from findmy.reports import (
     BaseAnisetteProvider,
     LoginState,
     SmsSecondFactorMethod,
-    TrustedDeviceSecondFactorMethod,
 )
 
-BLOB_PATH   = "account.json"
-BLOB_BASE_URL   = os.getenv("VERCEL_BLOB_STORE_URL")
-BLOB_URL    = f"{BLOB_BASE_URL}/{BLOB_PATH}"
-
-FERNET_KEY  = os.environ["BLOB_KEY"].encode()
-cipher      = Fernet(FERNET_KEY)
-
 CODE_RE = re.compile(r"\b(\d{6})\b")
 
-def _encrypt_json(obj: dict) -> bytes:
-    return cipher.encrypt(json.dumps(obj, separators=(",", ":")).encode())
-
-def _decrypt_json(blob: bytes) -> dict:
-    try:
-        return json.loads(cipher.decrypt(blob))
-    except InvalidToken:
-        raise ValueError("The blob could not be decrypted (wrong key or tampered data).")
-
-def _download_json(url: str) -> dict:
-    meta = vercel_blob.head(url)                          # cheap HEAD call
-    blob = requests.get(meta["downloadUrl"], timeout=10).content
-    return _decrypt_json(blob)
-
-def _upload_json(path: str, data: dict) -> None:
-    vercel_blob.put(
-        path,
-        _encrypt_json(data),
-        {
-            "contentType": "application/octet-stream",
-            "allowOverwrite": "true"
-        }
-    )
-
 def _fetch_code_from_twilio(max_wait: int = 30, poll_every: int = 5, freshness_secs: int = 60) -> str:
     sid   = os.environ["TWILIO_SID"]
     token = os.environ["TWILIO_SECRET"]
@@ -115,72 +112,370 @@ def _fetch_code_from_twilio(max_wait: int = 30, poll_every: int = 5, freshness_s
     raise TimeoutError("Timed out waiting for Apple 2FA SMS via Twilio.")
 
 def get_account_sync(anisette: BaseAnisetteProvider) -> AppleAccount:
+    """Restores the saved Apple account. Never logs in: that may wait on an SMS code, see refresh_session."""
     acc = AppleAccount(anisette)
 
-    try:
-        # ---------- RESTORE ----------
-        saved_state = _download_json(BLOB_URL)
-        acc.restore(saved_state)
-    except:
-        _login_sync(acc)
-        # ---------- SAVE --------------
-        _upload_json(BLOB_PATH, acc.export())
+    with span("account_restore"):
+        try:
+            # ---------- RESTORE ----------
+            acc.restore(load_state())
+        except Exception as e:
+            raise RuntimeError(f"No usable saved Apple session ({e}); /api/session.py (run by its cron, with CRON_SECRET) logs in again") from e
 
     return acc
 
+def refresh_session(force: bool = False) -> bool:
+    """
+    Re-authenticate the saved Apple session if it is older than the refresh interval, or log
+    in from scratch if there is none, so that a full (SMS 2FA) login never has to happen on
+    the request path. Returns True if the session was refreshed.
+    """
+    configure_logging()
+    return asyncio.run(_refresh_session_async(force))
+
+def _keep_latest(reports: list) -> list:
+    reports = sorted(reports)
+    return reports[-MAX_REPORTS_PER_KEY:] if len(reports) > MAX_REPORTS_PER_KEY else reports
+
+def _window_start(key: KeyPair, since: dt.datetime | None, now: dt.datetime) -> dt.datetime:
+    """
+    Start of the incremental fetch window for key: shortly before its newest buffered report,
+    or, on an instance that has not seen it yet, shortly before since, its last persisted
+    report. Only a beacon with neither is fetched HISTORY_HOURS back.
+    """
+    earliest = now - dt.timedelta(hours=FULL_WINDOW_HOURS)
+    overlap = dt.timedelta(minutes=OVERLAP_MIN)
+    with _buffers_lock:
+        buffered = _buffers.get(key)
+        newest = buffered[-1].timestamp if buffered else None
+    if newest is None:
+        newest = since
+    if newest is not None:
+        return max(earliest, newest - overlap)
+    return max(earliest, now - dt.timedelta(hours=HISTORY_HOURS))
+
+def _buffer_reports(key: KeyPair, fetched: list) -> list:
+    """Merge newly fetched reports into key's ring buffer; returns the buffered reports, oldest first."""
+    with _buffers_lock:
+        buffered = _buffers.setdefault(key, deque(maxlen=MAX_REPORTS_PER_KEY))
+        seen = {report.payload for report in buffered}
+        new = sorted(report for report in fetched if report.payload not in seen)
+        if new and buffered and new[0].timestamp < buffered[-1].timestamp:
+            # A late upload landed inside the buffered range; merge the two sorted runs
+            merged = list(heapq.merge(buffered, new))
+            buffered.clear()
+            buffered.extend(merged)
+        else:
+            buffered.extend(new)
+        return list(buffered)
+
+def _windows(keys: list, since: dict | None, now: dt.datetime) -> dict:
+    since = since or {}
+    return {key: _window_start(key, since.get(key), now) for key in keys}
+
+def _as_key(key) -> KeyPair:
+    """Keys may be given as KeyPair objects (see gtfs/beacons.py) or base64 private keys."""
+    return key if isinstance(key, KeyPair) else KeyPair.from_b64(key)
+
+def _query_range() -> tuple:
+    """The (start, end) in ms findmy asks Apple for; a narrower range is not honoured."""
+    now = dt.datetime.now().astimezone()
+    return (int((now - dt.timedelta(days=7, hours=12)).timestamp() * 1000),
+            int((now + dt.timedelta(hours=12)).timestamp() * 1000))
+
+def _new_reports(data: dict, keys: list, windows: dict) -> dict:
+    """
+    {KeyPair: LocationReports} in a fetch_raw_reports response, keeping each key's reports
+    from its window start on. The rest are dropped before they are decrypted, by their
+    publication time: a report is published after it is taken, so none of them is in the window.
+    """
+    by_hash = {key.hashed_adv_key_bytes: key for key in keys}
+    reports = {key: [] for key in keys}
+    for raw in data.get("results", []):
+        key = by_hash.get(base64.b64decode(raw["id"]))
+        if key is None:
+            continue
+        published_at = dt.datetime.fromtimestamp(raw.get("datePublished", 0) / 1000, tz=dt.timezone.utc)
+        if published_at < windows[key]:
+            continue
+        report = LocationReport(base64.b64decode(raw["payload"]), key.hashed_adv_key_bytes,
+                                published_at.astimezone(), raw.get("description", ""))
+        report.decrypt(key)
+        if report.timestamp >= windows[key]:
+            reports[key].append(report)
+    return reports
+
+async def _fetch_new_async(acc: AsyncAppleAccount, keys: list, windows: dict) -> dict:
+    """Reports of keys inside their windows, only those decrypted (see _new_reports)."""
+    start, end = _query_range()
+    reports = {}
+    for i in range(0, len(keys), MAX_KEYS_PER_QUERY):
+        chunk = keys[i:i + MAX_KEYS_PER_QUERY]
+        data = await acc.fetch_raw_reports(start, end, [key.hashed_adv_key_b64 for key in chunk])
+        reports.update(_new_reports(data, chunk, windows))
+    return reports
+
+def _fetch_new_sync(acc: AppleAccount, keys: list, windows: dict) -> dict:
+    # AppleAccount has no fetch_raw_reports; go through the async account it wraps, as its own methods do
+    return acc._evt_loop.run_until_complete(_fetch_new_async(acc._asyncacc, keys, windows))
+
+def _batch_reports(batch: list, fetched: dict, windows: dict) -> dict:
+    """{KeyPair: reports, oldest first} for one fetched batch of keys."""
+    if not windows:
+        return {key: _keep_latest(key_reports) for key, key_reports in fetched.items()}
+    # A key with nothing new still has its buffered history
+    return {key: _buffer_reports(key, fetched.get(key, [])) for key in batch}
+
+
+def _iter_reports_sync(priv_keys: MutableSequence, since: dict | None) -> typing.Iterator[dict]:
+    acc = get_account_sync(
+        RemoteAnisetteProvider(ANISETTE_SERVER),
+    )
+
+    print(f"Logged in as: {acc.account_name} ({acc.first_name} {acc.last_name})")
+
+    keys = [_as_key(priv_key) for priv_key in priv_keys]
+    windows = _windows(keys, since, dt.datetime.now().astimezone()) if FETCH_WINDOW == "incremental" else {}
+    for key in keys:
+        with span("report_fetch"):
+            if key in windows:
+                reports = _buffer_reports(key, _fetch_new_sync(acc, [key], windows)[key])
+            else:
+                reports = _keep_latest(acc.fetch_last_reports(key))
+        yield {key: reports}
+
+    # The library re-authenticates on a 401; keep the refreshed tokens.
+    save_state(acc.export())
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Block until q has room for item; False if the consumer stopped first."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _iter_reports_async(priv_keys: MutableSequence, since: dict | None) -> typing.Iterator[dict]:
+    # The event loop runs on its own thread and hands batches over through a bounded queue:
+    # once STREAM_QUEUE_SIZE batches are waiting, it stops starting new queries.
+    q = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stop = threading.Event()
+
+    async def produce():
+        batches = stream_reports_async(priv_keys, since=since)
+        try:
+            async for batch in batches:
+                if not await asyncio.to_thread(_put, q, batch, stop):
+                    break
+        finally:
+            await batches.aclose()
+
+    def run():
+        try:
+            asyncio.run(produce())
+            item = _DONE
+        except BaseException as e:
+            item = e
+        _put(q, item, stop)
+
+    # A copy of this context, so the fetch spans land in the caller's trace
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iter_reports(priv_keys: MutableSequence, since: dict | None = None) -> typing.Iterator[dict]:
+    """
+    Yield {KeyPair: reports, oldest first} one fetched batch at a time, as the batches come
+    back (in async mode, not in key order), so the caller can process a beacon as soon as
+    its reports arrive. since maps a key to the timestamp of its newest persisted report,
+    which bounds the first incremental fetch of it.
+    """
+    configure_logging()
+    archive = {} if is_recording() else None
+    batches = _iter_reports_async(priv_keys, since) if FETCH_MODE == "async" else _iter_reports_sync(priv_keys, since)
+    for batch in batches:
+        if archive is not None:
+            archive.update(batch)
+        yield batch
+    if archive is not None:
+        capture_reports(archive)
+
+
+def fetch_reports(priv_keys: MutableSequence, since: dict | None = None) -> dict:
+    """Fetch the reports of every key: {KeyPair: reports, oldest first}. See iter_reports."""
+    reports = {}
+    for batch in iter_reports(priv_keys, since=since):
+        reports.update(batch)
+    return reports
+
+
+async def stream_reports_async(
+    priv_keys: MutableSequence,
+    concurrency: int = FETCH_CONCURRENCY,
+    batch_size: int = FETCH_BATCH_SIZE,
+    since: dict | None = None,
+) -> typing.AsyncIterator[dict]:
+    """
+    Fetch reports for all keys concurrently, yielding {KeyPair: reports} per batch as each
+    completes. Keys are grouped into batches of batch_size (one upstream query each), with
+    at most concurrency queries in flight; the next query only starts once a finished batch
+    has been taken, so a slow consumer holds the fetch back instead of piling up results.
+    In incremental mode each key keeps only its reports since its window start.
+    """
+    acc = await get_account_async(
+        RemoteAnisetteProvider(ANISETTE_SERVER),
+    )
+
+    print(f"Logged in as: {acc.account_name} ({acc.first_name} {acc.last_name})")
+
+    keys = [_as_key(priv_key) for priv_key in priv_keys]
+    windows = _windows(keys, since, dt.datetime.now().astimezone()) if FETCH_WINDOW == "incremental" else {}
+    batches = deque(keys[i:i + batch_size] for i in range(0, len(keys), batch_size))
+
+    async def fetch_batch(batch: list) -> tuple:
+        with span("report_fetch", count=len(batch)):
+            if windows:
+                return batch, await _fetch_new_async(acc, batch, windows)
+            return batch, await acc.fetch_last_reports(batch)
 
-def _login_sync(account: AppleAccount) -> None:
+    in_flight = set()
+    try:
+        while batches or in_flight:
+            while batches and len(in_flight) < concurrency:
+                in_flight.add(asyncio.ensure_future(fetch_batch(batches.popleft())))
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield _batch_reports(*task.result(), windows)
+        # The library re-authenticates on a 401; keep the refreshed tokens.
+        await asyncio.to_thread(save_state, acc.export())
+    finally:
+        for task in in_flight:
+            task.cancel()
+        await acc.close()
+
+
+async def fetch_reports_async(
+    priv_keys: MutableSequence,
+    concurrency: int = FETCH_CONCURRENCY,
+    batch_size: int = FETCH_BATCH_SIZE,
+    since: dict | None = None,
+) -> dict:
+    """Fetch reports for all keys concurrently: {KeyPair: reports}. See stream_reports_async."""
+    reports = {}
+    async for batch in stream_reports_async(priv_keys, concurrency, batch_size, since):
+        reports.update(batch)
+    return reports
+
+
+async def _login_async(account: AsyncAppleAccount) -> None:
     email = os.environ.get("BEACON_EMAIL")
     password = os.environ.get("BEACON_PASSWORD")
 
-    state = account.login(email, password)
+    state = await account.login(email, password)
 
     if state == LoginState.REQUIRE_2FA:  # Account requires 2FA
         # This only supports SMS methods for now
-        
+
         twilio_digits = re.sub(r"\D", "", os.environ["TWILIO_NUMBER"])[-4:]
 
         sms_methods = [
-            m for m in account.get_2fa_methods() if isinstance(m, SmsSecondFactorMethod)
+            m for m in await account.get_2fa_methods() if isinstance(m, SmsSecondFactorMethod)
         ]
         if not sms_methods:
             raise RuntimeError("No SMS 2FA methods found on this Apple ID.")
 
         def last4(masked: str) -> str:
             return re.sub(r"\D", "", masked)[-4:]
-        
+
         method = next(
             (m for m in sms_methods if last4(m.phone_number) == twilio_digits),
             sms_methods[0]    # fallback to first SMS method
         )
 
-        method.request()
-        #code = input("Code? > ")
-        code = _fetch_code_from_twilio()
+        await method.request()
+        code = await asyncio.to_thread(_fetch_code_from_twilio)
 
         print("Twilio code received")
 
         # This automatically finishes the post-2FA login flow
-        method.submit(code)
+        await method.submit(code)
 
-def fetch_reports(priv_keys: MutableSequence[str]) -> int:
 
-    acc = get_account_sync(
-        RemoteAnisetteProvider(ANISETTE_SERVER),
-    )
+async def _login_fresh() -> AsyncAppleAccount:
+    acc = AsyncAppleAccount(RemoteAnisetteProvider(ANISETTE_SERVER))
+    try:
+        await _login_async(acc)
+    except BaseException:
+        await acc.close()
+        raise
+    return acc
 
-    print(f"Logged in as: {acc.account_name} ({acc.first_name} {acc.last_name})")
-    
-    reports = {}
 
-    for priv_key in priv_keys:
-        key = KeyPair.from_b64(priv_key)
-        temp_reports = acc.fetch_last_reports(key)
-        temp_reports = sorted(temp_reports)
-        temp_reports = temp_reports[-200:] if len(temp_reports) > 200 else temp_reports
-        reports[key] = temp_reports
+async def _reauthenticate(acc: AsyncAppleAccount) -> AsyncAppleAccount:
+    """
+    Renew the session's tokens with the stored credentials, as the library itself does on a
+    401; a full login only if Apple asks for 2FA again. Returns the account to keep.
+    """
+    try:
+        # Private in findmy, but the same two steps its report fetch takes to re-authenticate
+        if await acc._gsa_authenticate() == LoginState.AUTHENTICATED:
+            await acc._login_mobileme()
+            return acc
+        print("Re-authentication requires 2FA, logging in again")
+    except Exception as e:
+        print(f"Could not re-authenticate the saved session, logging in again: {e}")
+    await acc.close()
+    return await _login_fresh()
+
+
+async def _refresh_session_async(force: bool) -> bool:
+    acc = AsyncAppleAccount(RemoteAnisetteProvider(ANISETTE_SERVER))
+    try:
+        try:
+            acc.restore(await asyncio.to_thread(load_state))
+        except Exception as e:
+            print(f"Could not restore saved account session, logging in: {e}")
+            await acc.close()
+            acc = await _login_fresh()
+        else:
+            if not force and not needs_refresh():
+                return False
+            acc = await _reauthenticate(acc)
+
+        await asyncio.to_thread(save_state, acc.export(), True)
+        return True
+    finally:
+        await acc.close()
 
-    return reports
+
+async def get_account_async(anisette: BaseAnisetteProvider) -> AsyncAppleAccount:
+    """Restores the saved Apple account (async). Never logs in: that is refresh_session's job."""
+    acc = AsyncAppleAccount(anisette)
+
+    with span("account_restore"):
+        try:
+            # ---------- RESTORE ----------
+            acc.restore(await asyncio.to_thread(load_state))
+        except Exception as e:
+            await acc.close()
+            raise RuntimeError(f"No usable saved Apple session ({e}); /api/session.py (run by its cron, with CRON_SECRET) logs in again") from e
+
+    return acc
 
 
 if __name__ == "__main__":
@@ -191,46 +486,3 @@ if __name__ == "__main__":
         sys.exit(1)
 
     sys.exit(fetch_reports(sys.argv[1]))
-
-async def _login_async(account: AsyncAppleAccount) -> None:
-    email = input("email?  > ")
-    password = input("passwd? > ")
-
-    state = await account.login(email, password)
-
-    if state == LoginState.REQUIRE_2FA:  # Account requires 2FA
-        # This only supports SMS methods for now
-        methods = await account.get_2fa_methods()
-
-        # Print the (masked) phone numbers
-        for i, method in enumerate(methods):
-            if isinstance(method, TrustedDeviceSecondFactorMethod):
-                print(f"{i} - Trusted Device")
-            elif isinstance(method, SmsSecondFactorMethod):
-                print(f"{i} - SMS ({method.phone_number})")
-
-        ind = int(input("Method? > "))
-
-        method = methods[ind]
-        await method.request()
-        code = input("Code? > ")
-
-        # This automatically finishes the post-2FA login flow
-        await method.submit(code)
-
-
-async def get_account_async(anisette: BaseAnisetteProvider) -> AsyncAppleAccount:
-    """Tries to restore a saved Apple account, or prompts the user for login otherwise. (async)"""
-    acc = AsyncAppleAccount(anisette)
-
-    # Save / restore account logic
-    acc_store = Path("account.json")
-    try:
-        with acc_store.open() as f:
-            acc.restore(json.load(f))
-    except FileNotFoundError:
-        await _login_async(acc)
-        with acc_store.open("w+") as f:
-            json.dump(acc.export(), f)
-
-    return acc
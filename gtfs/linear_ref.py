@@ -0,0 +1,99 @@
+import math
+import numpy as np
+from gtfs.route_index import CELL_SIZE, GridIndex, _point_segment_distance
+
+# How far (meters) a beacon must move along the line between two fixes before a direction is inferred.
+MIN_MOVE = 100
+
+
+class LinearReference(GridIndex):
+    """
+    Linear referencing along one shape of a line, built once per process.
+
+    Positions are expressed as chainage: meters along the shape, measured from the first
+    stop of the line's stop sequence (its north terminus), so chainage grows Southbound.
+    The shape is stored as cumulative distances at each vertex, every stop gets its
+    chainage, and a fix is projected onto the shape through a grid over its segments.
+    After that, direction and distance to a terminus are a subtraction.
+    """
+
+    def __init__(self, line, points, stops, sequence, cell_size=CELL_SIZE):
+        """points: the shape's (lat, lon) vertices in order; stops: stop dicts; sequence: stop ids north to south."""
+        super().__init__([lat for lat, _ in points], [lon for _, lon in points], cell_size)
+        self.line = line
+        self.sequence = list(sequence)
+        self.stops = {}
+        for stop in stops:
+            self.stops.setdefault(stop["stop_id"], stop)
+
+        xy = np.array([self.project(lat, lon) for lat, lon in points], dtype=float).reshape(-1, 2)
+        cumulative = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T)))) if len(xy) else np.zeros(0)
+        self._set_shape(xy, cumulative)
+
+        # Orient the shape so chainage grows from the first stop of the sequence to the last
+        first, last = (self.stops.get(stop_id) for stop_id in (self.sequence[0], self.sequence[-1]))
+        if first and last and self.bounds is not None and self.locate(first["lat"], first["lon"])[0] > self.locate(last["lat"], last["lon"])[0]:
+            self._set_shape(xy[::-1], cumulative[-1] - cumulative[::-1])
+
+        # Chainage of each stop in the sequence, in sequence order (non-decreasing)
+        self.stop_ids, chainages = [], []
+        for stop_id in self.sequence:
+            stop = self.stops.get(stop_id)
+            if stop and self.bounds is not None:
+                self.stop_ids.append(stop_id)
+                chainages.append(self.locate(stop["lat"], stop["lon"])[0])
+        self.stop_chainages = list(np.maximum.accumulate(chainages)) if chainages else []
+
+    def _set_shape(self, xy, cumulative):
+        self.xy = xy
+        self.cumulative = cumulative
+        self.length = float(cumulative[-1]) if len(cumulative) else 0.0
+        self.segments = [(*xy[i], *xy[i + 1]) for i in range(len(xy) - 1)]
+        self.grid, self.bounds = {}, None
+        for i, (x1, y1, x2, y2) in enumerate(self.segments):
+            if x1 != x2 or y1 != y2:
+                self._add(i, min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        if self.grid:
+            self._finish()
+
+    @classmethod
+    def from_shapes(cls, line, shapes, stops, sequence, cell_size=CELL_SIZE):
+        """Build from shape point dicts (as returned by load_shapes), using the shape with the most points."""
+        by_shape = {}
+        for pt in shapes:
+            by_shape.setdefault(pt["shape_id"], []).append(pt)
+        if not by_shape:
+            return cls(line, [], stops, sequence, cell_size)
+        points = max(by_shape.values(), key=len)
+        points.sort(key=lambda p: p["shape_pt_sequence"])
+        return cls(line, [(p["lat"], p["lon"]) for p in points], stops, sequence, cell_size)
+
+    def locate(self, lat, lon, max_distance=None):
+        """
+        Project (lat, lon) onto the shape. Returns (chainage, offset), offset being the
+        distance in meters from the shape; (None, inf) if nothing lies within max_distance.
+        """
+        i, offset = self._nearest(
+            lat, lon, lambda px, py, i: _point_segment_distance(px, py, *self.segments[i]), max_distance
+        )
+        if i is None:
+            return None, offset
+        x1, y1, x2, y2 = self.segments[i]
+        px, py = self.project(lat, lon)
+        dx, dy = x2 - x1, y2 - y1
+        t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / (dx * dx + dy * dy)))
+        return float(self.cumulative[i] + t * math.hypot(dx, dy)), offset
+
+    def direction(self, from_chainage, to_chainage, min_move=MIN_MOVE):
+        """Direction of travel between two fixes (oldest first), or "Unknown" if it moved less than min_move."""
+        if from_chainage is None or to_chainage is None or abs(to_chainage - from_chainage) < min_move:
+            return "Unknown"
+        return "Southbound" if to_chainage > from_chainage else "Northbound"
+
+    def distance_to_terminus(self, chainage, direction):
+        """Meters left along the line to the terminus the beacon is heading for, or None."""
+        if not self.stop_chainages or direction not in ("Southbound", "Northbound"):
+            return None
+        if direction == "Southbound":
+            return max(0.0, self.stop_chainages[-1] - chainage)
+        return max(0.0, chainage - self.stop_chainages[0])
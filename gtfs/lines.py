@@ -0,0 +1,79 @@
+from functools import cached_property, lru_cache
+from pathlib import Path
+import numpy as np
+
+# The line registry: per line, its realtime feed, stops, station sequence (north terminus
+# first), termini and shape points, loaded from the artifact built by `python -m gtfs.build_lines`.
+
+ARTIFACT_PATH = Path(__file__).with_name("lines.npz")
+
+
+class Line:
+    """
+    Static data for one line. Southbound runs from the first station of the sequence to the last.
+    The stop and shape records are only built when first used, so loading the registry costs
+    the same however many lines it holds.
+    """
+
+    def __init__(self, line, arrays):
+        self.line = line
+        self._arrays = arrays
+        self.feed = str(arrays[f"{line}.feed"])  # name of the realtime feed the line is in (gtfs.feeds.MTA_FEEDS)
+        self.sequence = [str(stop_id) for stop_id in arrays[f"{line}.sequence"]]
+        self.north_terminus, self.south_terminus = self.sequence[0], self.sequence[-1]
+
+        stop_ids = arrays[f"{line}.stop_id"].tolist()
+        lats, lons = arrays[f"{line}.stop_lat"], arrays[f"{line}.stop_lon"]
+        self.termini = {}
+        for stop_id in (self.south_terminus, self.north_terminus):
+            i = stop_ids.index(stop_id)
+            self.termini[stop_id] = (float(lats[i]), float(lons[i]))
+        # Terminus a trip that left each terminus is headed for, as a GTFS stop id with direction
+        self.expected_termini = {
+            self.north_terminus: self.south_terminus + "S",
+            self.south_terminus: self.north_terminus + "N",
+        }
+
+    def __repr__(self):
+        return f"Line({self.line}: {self.north_terminus}-{self.south_terminus}, {len(self.sequence)} stations)"
+
+    @cached_property
+    def stops(self):
+        """Stop dicts (stations and their N/S platforms), as load_stops returns them."""
+        a, line = self._arrays, self.line
+        return [
+            {"stop_id": stop_id, "stop_name": name, "lat": lat, "lon": lon}
+            for stop_id, name, lat, lon in zip(a[f"{line}.stop_id"].tolist(), a[f"{line}.stop_name"].tolist(),
+                                               a[f"{line}.stop_lat"].tolist(), a[f"{line}.stop_lon"].tolist())
+        ]
+
+    @cached_property
+    def shapes(self):
+        """Shape point dicts, as load_shapes returns them."""
+        a, line = self._arrays, self.line
+        return [
+            {"shape_id": shape_id, "shape_pt_sequence": seq, "lat": lat, "lon": lon}
+            for shape_id, seq, lat, lon in zip(a[f"{line}.shape_id"].tolist(), a[f"{line}.shape_seq"].tolist(),
+                                               a[f"{line}.shape_lat"].tolist(), a[f"{line}.shape_lon"].tolist())
+        ]
+
+
+@lru_cache(maxsize=None)
+def load_lines(path=ARTIFACT_PATH):
+    """
+    Load (once per process) every line in the registry: {line id: Line}.
+    Falls back to compiling the sources if the artifact has not been built.
+    """
+    try:
+        with np.load(path, allow_pickle=False) as artifact:
+            arrays = {name: artifact[name] for name in artifact.files}
+    except FileNotFoundError:
+        from gtfs.build_lines import compile_lines
+        print(f"{path} not found; compiling the line registry from its sources (python -m gtfs.build_lines)")
+        arrays = compile_lines()
+    return {line: Line(line, arrays) for line in arrays["lines"].tolist()}
+
+
+def get_line(line):
+    """The Line for a line id, or None if the line is not in the registry."""
+    return load_lines().get(line)
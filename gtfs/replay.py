@@ -0,0 +1,144 @@
+import base64
+import gzip
+import json
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Record/replay of the raw inputs of a run: the Find My reports (still encrypted, as Apple
+# returned them) and the GTFS-realtime feed bytes. With REPLAY_MODE=record every traced run of
+# /api/index.py writes REPLAY_DIR/<run>-<UTC time>/ containing
+#
+#     meta.json        {"name", "recorded_at"}
+#     reports.json.gz  {beacon private key: [[payload b64, published_at, description], ...]}
+#     feed-<line>.pb   raw feed bytes
+#
+# The archive holds the beacons' private keys (the replay has to decrypt the reports), so
+# keep it somewhere private. `python -m bench replay <dir>` feeds archives back through the
+# pipeline with no network.
+
+REPLAY_MODE = os.environ.get("REPLAY_MODE", "")
+REPLAY_DIR = Path(os.environ.get("REPLAY_DIR", "/tmp/replay"))
+
+_recording = ContextVar("replay_recording", default=None)  # directory of the run being recorded
+_clock = ContextVar("replay_clock", default=None)  # recorded_at of the run being replayed
+
+
+@contextmanager
+def recording(name):
+    """Archive the inputs captured in this context if REPLAY_MODE=record; a no-op otherwise."""
+    if REPLAY_MODE != "record":
+        yield None
+        return
+    recorded_at = datetime.now(timezone.utc)
+    run_dir = REPLAY_DIR / f"{name}-{recorded_at.strftime('%Y%m%dT%H%M%S.%fZ')}"
+    run_dir.mkdir(parents=True, exist_ok=True)
+    (run_dir / "meta.json").write_text(json.dumps({"name": name, "recorded_at": recorded_at.isoformat()}))
+    token = _recording.set(run_dir)
+    try:
+        yield run_dir
+    finally:
+        _recording.reset(token)
+
+
+def is_recording():
+    """True while the inputs of a run are being archived."""
+    return _recording.get() is not None
+
+
+def capture_reports(reports):
+    """Archive fetch_reports' result (KeyPair -> location reports) for the run being recorded."""
+    run_dir = _recording.get()
+    if run_dir is None:
+        return
+    archived = {
+        key.private_key_b64: [
+            [base64.b64encode(report.payload).decode(), report.published_at.isoformat(), report.description]
+            for report in key_reports
+        ]
+        for key, key_reports in reports.items()
+    }
+    try:
+        with gzip.open(run_dir / "reports.json.gz", "wt") as f:
+            json.dump(archived, f)
+    except OSError as e:
+        print(f"Could not archive reports to {run_dir}: {e}")
+
+
+def capture_feed(line, data):
+    """Archive the raw feed bytes of line for the run being recorded."""
+    run_dir = _recording.get()
+    if run_dir is None:
+        return
+    try:
+        (run_dir / f"feed-{line}.pb").write_bytes(data)
+    except OSError as e:
+        print(f"Could not archive {line} feed to {run_dir}: {e}")
+
+
+def now(tz=None):
+    """datetime.now(tz), except while replaying, when it is the time the run was recorded."""
+    replayed = _clock.get()
+    if replayed is None:
+        return datetime.now(tz)
+    return replayed.astimezone(tz) if tz else replayed
+
+
+# ----- Replay -----
+def runs(archive):
+    """Recorded run directories under archive (or archive itself), oldest first."""
+    archive = Path(archive)
+    if (archive / "meta.json").exists():
+        return [archive]
+    return sorted((p.parent for p in archive.glob("*/meta.json")), key=lambda p: load_meta(p)["recorded_at"])
+
+
+def load_meta(run_dir):
+    meta = json.loads((Path(run_dir) / "meta.json").read_text())
+    meta["recorded_at"] = datetime.fromisoformat(meta["recorded_at"])
+    return meta
+
+
+def load_reports(run_dir):
+    """The archived reports as fetch_reports returned them: KeyPair -> decrypted LocationReports."""
+    from findmy import KeyPair
+    from findmy.reports.reports import LocationReport
+
+    path = Path(run_dir) / "reports.json.gz"
+    if not path.exists():
+        return {}
+    with gzip.open(path, "rt") as f:
+        archived = json.load(f)
+
+    reports = {}
+    for priv_key, rows in archived.items():
+        key = KeyPair.from_b64(priv_key)
+        key_reports = []
+        for payload, published_at, description in rows:
+            report = LocationReport(base64.b64decode(payload), key.hashed_adv_key_bytes,
+                                    datetime.fromisoformat(published_at), description)
+            try:
+                report.decrypt(key)
+            except Exception:
+                pass  # left encrypted, as it was when fetched; decode_reports skips it
+            key_reports.append(report)
+        reports[key] = key_reports
+    return reports
+
+
+def load_feed(run_dir, line):
+    """The archived feed bytes of line, or None if that feed was not loaded in the run."""
+    path = Path(run_dir) / f"feed-{line}.pb"
+    return path.read_bytes() if path.exists() else None
+
+
+@contextmanager
+def replaying(run_dir):
+    """Run the enclosed block with now() returning the recorded time of run_dir."""
+    token = _clock.set(load_meta(run_dir)["recorded_at"])
+    try:
+        yield
+    finally:
+        _clock.reset(token)
@@ -0,0 +1,42 @@
+from gtfs.db import to_db_timestamp
+
+class Report:
+    """A decoded beacon location report."""
+
+    __slots__ = ("beacon_id", "hashed_adv_key", "timestamp", "latitude", "longitude")
+
+    def __init__(self, beacon_id, hashed_adv_key, timestamp, latitude, longitude):
+        self.beacon_id = beacon_id
+        self.hashed_adv_key = hashed_adv_key
+        self.timestamp = timestamp
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def __repr__(self):
+        # beacon_id is the beacon's private key, so it is left out.
+        return f"Report(timestamp={self.timestamp}, lat={self.latitude}, lon={self.longitude})"
+
+    def as_row(self, fetch_id):
+        """Column values for an INSERT into "BeaconReport"."""
+        return (fetch_id, self.beacon_id, self.hashed_adv_key, to_db_timestamp(self.timestamp), self.latitude, self.longitude)
+
+
+def decode_reports(beacon_id, key_reports):
+    """
+    Decode findmy KeyReport objects into Report records, oldest first.
+    Each property is read once (KeyReport re-unpacks its payload on every access);
+    reports that could not be decrypted carry no location and are skipped.
+    """
+    decoded = []
+    for report in key_reports:
+        if not report.is_decrypted:
+            continue
+        decoded.append(Report(
+            beacon_id,
+            report.hashed_adv_key_b64,
+            report.timestamp,
+            report.latitude,
+            report.longitude,
+        ))
+    decoded.sort(key=lambda r: r.timestamp)
+    return decoded
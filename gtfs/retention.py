@@ -0,0 +1,101 @@
+import os
+from datetime import datetime, timedelta, timezone
+from psycopg2 import sql
+
+def _retention(name, unit, default=""):
+    """Retention from the environment variable name, counted in unit ("hours"/"days"); unset or 0 keeps everything."""
+    value = os.environ.get(name, default)
+    return timedelta(**{unit: float(value)}) if value and float(value) > 0 else None
+
+# Time-partitioned tables. Each partition covers one period of the partition column;
+# a partition is dropped as a whole once its period ends before now - retention
+# (never, for a table without a retention). Timestamps are stored without a time zone, in UTC.
+PARTITIONED_TABLES = [
+    # (table, partition column, period, retention)
+    # Raw beacon reports are only needed for matching; the request path used to delete them after 4 hours
+    ("BeaconReport", "timestamp", timedelta(hours=1), _retention("BEACON_REPORT_RETENTION_HOURS", "hours", "4")),
+    # Archives, kept for good unless a retention is configured
+    ("VehiclePosition", "createdAt", timedelta(days=1), _retention("VEHICLE_POSITION_RETENTION_DAYS", "days")),
+    ("BeaconTripMapping", "createdAt", timedelta(days=1), _retention("TRIP_MAPPING_RETENTION_DAYS", "days")),
+]
+
+# Future partitions kept ready, so inserts keep landing in real partitions even if the
+# prune job misses a few runs (rows in the default partition would block creating them).
+PARTITIONS_AHEAD = timedelta(days=2)
+
+LIST_PARTITIONS = """
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+JOIN pg_class p ON p.oid = i.inhparent
+WHERE p.relname = %s
+"""
+
+def _name_format(period):
+    return "%Y%m%d%H" if period < timedelta(days=1) else "%Y%m%d"
+
+def _period_start(ts, period):
+    if period < timedelta(days=1):
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def partition_name(table, start, period):
+    """e.g. BeaconReport_p2025031114 (hourly) or VehiclePosition_p20250311 (daily)."""
+    return f"{table}_p{start.strftime(_name_format(period))}"
+
+def _partition_start(table, name, period):
+    prefix = f"{table}_p"
+    if not name.startswith(prefix):
+        return None  # e.g. the default partition
+    try:
+        return datetime.strptime(name[len(prefix):], _name_format(period))
+    except ValueError:
+        return None
+
+def ensure_partitions(cur, table, period, now, ahead=PARTITIONS_AHEAD):
+    """Create the partitions covering now through now + ahead."""
+    start = _period_start(now, period)
+    for i in range(int(ahead / period) + 1):
+        lower = start + i * period
+        cur.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+                sql.Identifier(partition_name(table, lower, period)),
+                sql.Identifier(table),
+            ),
+            (lower, lower + period),
+        )
+
+def drop_expired_partitions(cur, table, column, period, retention, now):
+    """
+    Detach and drop every partition whose period ended before now - retention.
+    Rows that landed in the default partition (reports older than any partition)
+    are deleted there; that partition only ever holds stragglers, so this stays small.
+    Returns the names of the dropped partitions.
+    """
+    cutoff = now - retention
+    cur.execute(LIST_PARTITIONS, (table,))
+    dropped = []
+    for (name,) in cur.fetchall():
+        start = _partition_start(table, name, period)
+        if start is None or start + period > cutoff:
+            continue
+        cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(sql.Identifier(table), sql.Identifier(name)))
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+        dropped.append(name)
+
+    cur.execute(
+        sql.SQL("DELETE FROM {} WHERE {} < %s").format(sql.Identifier(f"{table}_default"), sql.Identifier(column)),
+        (cutoff,),
+    )
+    return dropped
+
+def prune(conn, now=None):
+    """Roll partitions forward and drop expired ones for every partitioned table."""
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    summary = {}
+    with conn.cursor() as cur:
+        for table, column, period, retention in PARTITIONED_TABLES:
+            ensure_partitions(cur, table, period, now)
+            summary[table] = drop_expired_partitions(cur, table, column, period, retention, now) if retention else []
+            conn.commit()
+    return summary
@@ -0,0 +1,198 @@
+import math
+
+EARTH_RADIUS = 6371000  # Earth's radius in meters.
+CELL_SIZE = 250  # Grid cell edge length in meters.
+
+
+class GridIndex:
+    """
+    Uniform grid over items projected to a local equirectangular plane (meters).
+
+    The plane is centred on the indexed data, which keeps it accurate to well under
+    a meter at the scale of a subway line. Each item is registered in every grid cell
+    its bounding box touches, so a nearest-item query only has to look at the rings
+    of cells around the query point.
+    """
+
+    def __init__(self, lats, lons, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.grid = {}
+        self.bounds = None
+        if not lats:
+            return
+        self.lat0 = (min(lats) + max(lats)) / 2
+        self.lon0 = (min(lons) + max(lons)) / 2
+        self.kx = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(self.lat0))
+        self.ky = math.radians(1) * EARTH_RADIUS
+
+    def project(self, lat, lon):
+        """Project a lat/lon onto the local plane, returning (x, y) in meters."""
+        return (lon - self.lon0) * self.kx, (lat - self.lat0) * self.ky
+
+    def _cell(self, v):
+        return math.floor(v / self.cell_size)
+
+    def _add(self, item_id, x_min, y_min, x_max, y_max):
+        for cx in range(self._cell(x_min), self._cell(x_max) + 1):
+            for cy in range(self._cell(y_min), self._cell(y_max) + 1):
+                self.grid.setdefault((cx, cy), []).append(item_id)
+
+    def _finish(self):
+        cells_x = [cx for cx, _ in self.grid]
+        cells_y = [cy for _, cy in self.grid]
+        self.bounds = (min(cells_x), min(cells_y), max(cells_x), max(cells_y))
+
+    def _ring(self, cx, cy, r):
+        """Yield the grid cells at Chebyshev distance r from (cx, cy), clipped to the grid bounds."""
+        min_x, min_y, max_x, max_y = self.bounds
+        if r == 0:
+            yield cx, cy
+            return
+        x_lo, x_hi = max(cx - r, min_x), min(cx + r, max_x)
+        for y in (cy - r, cy + r):
+            if min_y <= y <= max_y:
+                for x in range(x_lo, x_hi + 1):
+                    yield x, y
+        y_lo, y_hi = max(cy - r + 1, min_y), min(cy + r - 1, max_y)
+        for x in (cx - r, cx + r):
+            if min_x <= x <= max_x:
+                for y in range(y_lo, y_hi + 1):
+                    yield x, y
+
+    def _nearest(self, lat, lon, item_distance, max_distance=None):
+        """
+        Return (item_id, distance) of the item closest to (lat, lon), where
+        item_distance(px, py, item_id) is the planar distance to one item.
+        If max_distance is given the search stops once nothing closer than that can
+        exist, and (None, float('inf')) is returned when no item lies within it.
+        """
+        if self.bounds is None:
+            return None, float("inf")
+
+        px, py = self.project(lat, lon)
+        cx, cy = self._cell(px), self._cell(py)
+        min_x, min_y, max_x, max_y = self.bounds
+        first_ring = max(0, min_x - cx, cx - max_x, min_y - cy, cy - max_y)
+        last_ring = max(cx - min_x, max_x - cx, cy - min_y, max_y - cy)
+
+        best_id, best = None, float("inf")
+        checked = set()
+        for r in range(first_ring, last_ring + 1):
+            # Every item outside rings 0..r-1 is at least (r - 1) cells away.
+            floor = (r - 1) * self.cell_size if r else 0
+            if best <= floor or (max_distance is not None and floor > max_distance):
+                break
+            for cell in self._ring(cx, cy, r):
+                for item_id in self.grid.get(cell, ()):
+                    if item_id in checked:
+                        continue
+                    checked.add(item_id)
+                    d = item_distance(px, py, item_id)
+                    if d < best:
+                        best_id, best = item_id, d
+
+        if max_distance is not None and best > max_distance:
+            return None, float("inf")
+        return best_id, best
+
+
+class RouteIndex(GridIndex):
+    """Grid over the deduplicated segments of a line's shapes, for "distance to route" queries."""
+
+    def __init__(self, segments, cell_size=CELL_SIZE):
+        super().__init__(
+            [lat for seg in segments for lat in (seg[0], seg[2])],
+            [lon for seg in segments for lon in (seg[1], seg[3])],
+            cell_size,
+        )
+        self.segments = []
+        if not segments:
+            return
+
+        for lat1, lon1, lat2, lon2 in segments:
+            x1, y1 = self.project(lat1, lon1)
+            x2, y2 = self.project(lat2, lon2)
+            self._add(len(self.segments), min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+            self.segments.append((x1, y1, x2, y2))
+        self._finish()
+
+    @classmethod
+    def from_shapes(cls, shapes, cell_size=CELL_SIZE):
+        """
+        Build an index from shape point dicts (as returned by load_shapes).
+        Zero-length segments and segments shared by several shapes are only kept once.
+        """
+        by_shape = {}
+        for pt in shapes:
+            by_shape.setdefault(pt["shape_id"], []).append(pt)
+
+        seen = set()
+        segments = []
+        for points in by_shape.values():
+            points.sort(key=lambda p: p["shape_pt_sequence"])
+            for a, b in zip(points, points[1:]):
+                start = (round(a["lat"], 6), round(a["lon"], 6))
+                end = (round(b["lat"], 6), round(b["lon"], 6))
+                if start == end:
+                    continue
+                key = (start, end) if start <= end else (end, start)
+                if key in seen:
+                    continue
+                seen.add(key)
+                segments.append((*start, *end))
+        return cls(segments, cell_size)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def distance(self, lat, lon, max_distance=None):
+        """
+        Return the distance (in meters) from (lat, lon) to the nearest route segment.
+        If max_distance is given the search stops once nothing closer than that can
+        exist, and float('inf') is returned when no segment lies within it.
+        """
+        _, best = self._nearest(
+            lat, lon, lambda px, py, i: _point_segment_distance(px, py, *self.segments[i]), max_distance
+        )
+        return best
+
+
+class PointIndex(GridIndex):
+    """Grid over point items (e.g. stops), for nearest-item queries."""
+
+    def __init__(self, items, cell_size=CELL_SIZE):
+        super().__init__([item["lat"] for item in items], [item["lon"] for item in items], cell_size)
+        self.items = []
+        self.points = []
+        if not items:
+            return
+
+        for item in items:
+            x, y = self.project(item["lat"], item["lon"])
+            self._add(len(self.items), x, y, x, y)
+            self.items.append(item)
+            self.points.append((x, y))
+        self._finish()
+
+    def __len__(self):
+        return len(self.items)
+
+    def nearest(self, lat, lon, max_distance=None):
+        """Return (item, planar distance in meters) for the item closest to (lat, lon), or (None, inf)."""
+        def item_distance(px, py, i):
+            x, y = self.points[i]
+            return math.hypot(px - x, py - y)
+
+        best_id, best = self._nearest(lat, lon, item_distance, max_distance)
+        return (self.items[best_id] if best_id is not None else None), best
+
+
+def _point_segment_distance(px, py, x1, y1, x2, y2):
+    """Planar distance from point P to segment AB."""
+    dx, dy = x2 - x1, y2 - y1
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(px - x1, py - y1)
+    t = ((px - x1) * dx + (py - y1) * dy) / length_sq
+    t = max(0.0, min(1.0, t))
+    return math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
@@ -0,0 +1,38 @@
+from gtfs.route_index import PointIndex
+
+
+class LineTopology:
+    """
+    Stop lookup tables for one line, built once per process:
+    stop id -> record, stop id -> position in the stop sequence, the next stop
+    in each direction, and a spatial index for nearest-stop queries.
+    Southbound runs from the first stop in the sequence to the last.
+    """
+
+    def __init__(self, line, stops, sequence):
+        self.line = line
+        self.sequence = list(sequence)
+        self.stops = {}
+        for stop in stops:
+            self.stops.setdefault(stop["stop_id"], stop)
+        self.position = {stop_id: i for i, stop_id in enumerate(self.sequence)}
+        self.next = {
+            "Southbound": dict(zip(self.sequence, self.sequence[1:])),
+            "Northbound": dict(zip(self.sequence[1:], self.sequence)),
+        }
+
+        # One entry per location: parent stations come before their N/S platforms in the
+        # stops file, so ties resolve to the station id used in the stop sequence.
+        by_location = {}
+        for stop in stops:
+            by_location.setdefault((stop["lat"], stop["lon"]), stop)
+        self.stop_index = PointIndex(list(by_location.values()))
+
+    def nearest_stop(self, lat, lon):
+        """Return the nearest stop (and its distance in meters), or (None, inf) if there are no stops."""
+        return self.stop_index.nearest(lat, lon)
+
+    def next_stop(self, stop_id, direction):
+        """The stop after stop_id when travelling in direction, or None at the end of the line."""
+        next_id = self.next.get(direction, {}).get(stop_id)
+        return self.stops.get(next_id) if next_id else None
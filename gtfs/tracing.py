@@ -0,0 +1,103 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+# Lightweight stage timing for a single run of a handler.
+#
+#     with trace("index") as t:
+#         with span("report_fetch", count=len(keys)):
+#             ...
+#     t.summary()  # {"name", "total_ms", "stages": {stage: {"calls", "count", "total_ms", "max_ms"}}}
+#
+# The active trace is held in a context variable, so library code records spans without it
+# being passed around; spans outside a trace cost a context variable lookup and nothing else.
+# asyncio tasks and asyncio.to_thread inherit the trace; plain threads only do when run
+# through contextvars.copy_context().
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def configure_logging():
+    """INFO-level logging for the handlers, set up on first use instead of as an import side effect."""
+    logging.basicConfig(level=logging.INFO)
+
+_current = ContextVar("trace", default=None)
+
+
+class Span:
+    """Handle yielded by span(); set count once the number of items processed is known."""
+
+    __slots__ = ("stage", "count")
+
+    def __init__(self, stage, count):
+        self.stage = stage
+        self.count = count
+
+
+class Trace:
+    """Per-stage call counts, item counts and durations for one run."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, elapsed, count=1):
+        with self._lock:
+            s = self.stages.setdefault(stage, {"calls": 0, "count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            s["calls"] += 1
+            s["count"] += count
+            s["total_ms"] += elapsed * 1000
+            s["max_ms"] = max(s["max_ms"], elapsed * 1000)
+
+    def summary(self):
+        with self._lock:
+            stages = {
+                stage: {**s, "total_ms": round(s["total_ms"], 2), "max_ms": round(s["max_ms"], 2)}
+                for stage, s in self.stages.items()
+            }
+        return {
+            "name": self.name,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "stages": stages,
+        }
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def trace(name):
+    """Collect spans recorded in this context; the summary is logged as one JSON line on exit."""
+    configure_logging()
+    t = Trace(name)
+    token = _current.set(t)
+    try:
+        yield t
+    finally:
+        _current.reset(token)
+        logger.info(json.dumps({"trace": t.summary()}))
+
+
+@contextmanager
+def span(stage, count=1):
+    """Time the enclosed block as one call of stage in the active trace (if any)."""
+    t = _current.get()
+    s = Span(stage, count)
+    if t is None:
+        yield s
+        return
+    start = time.perf_counter()
+    try:
+        yield s
+    finally:
+        elapsed = time.perf_counter() - start
+        t.add(stage, elapsed, s.count)
+        logger.debug(json.dumps({"span": stage, "count": s.count, "ms": round(elapsed * 1000, 2)}))
@@ -1,9 +1,14 @@
-import csv
 import math
 import os
-from gtfs.fetch_reports import fetch_reports
-import pytz
-from nyct_gtfs import NYCTFeed  # Using NYCTFeed from nyct_gtfs
+import numpy as np
+from functools import lru_cache
+from gtfs.route_index import RouteIndex
+from gtfs.topology import LineTopology
+from gtfs.linear_ref import LinearReference
+from gtfs.lines import get_line
+from zoneinfo import ZoneInfo
+from gtfs.feeds import shared_feeds
+from gtfs.tracing import span
 
 # Constants
 STOP_RADIUS = 200  # meters
@@ -12,96 +17,8 @@ MATCH_WINDOW_SEC = 240  # ±4 minutes for matching departure time
 
 ANISETTE_SERVER = os.environ.get("ANISETTE_SERVER")
 
-# Terminus coordinates for G and C trains.
-TERMINUS_COORDS_G = {
-    "F27": (40.644041, -73.979678),  # Church Av (south terminus)
-    "G22": (40.746554, -73.943832)   # Court Sq (north terminus)
-}
-
-TERMINUS_COORDS_C = {
-    "A09": (40.840719, -73.939561),  # 168 St (north terminus)
-    "A55": (40.675377, -73.872106)   # Euclid Av (south terminus)
-}
-
-# Stop sequences for G and C trains.
-STOP_SEQUENCE_G = [
-    "G22",  # Court Sq (north terminus)
-    "G24",  # 21 St
-    "G26",  # Greenpoint Av
-    "G28",  # Nassau Av
-    "G29",  # Metropolitan Av
-    "G30",  # Broadway
-    "G31",  # Flushing Av
-    "G32",  # Myrtle–Willoughby Avs
-    "G33",  # Bedford–Nostrand Avs
-    "G34",  # Classon Av
-    "G35",  # Clinton–Washington Avs
-    "G36",  # Fulton St
-    "A42",  # Hoyt–Schermerhorn Sts
-    "F20",  # Bergen St
-    "F21",  # Carroll St
-    "F22",  # Smith–9 Sts
-    "F23",  # 4 Av
-    "F24",  # 7 Av
-    "F25",  # 15 St–Prospect Park
-    "F26",  # Fort Hamilton Pkwy
-    "F27"   # Church Av (south terminus)
-]
-
-STOP_SEQUENCE_C = [
-    "A09",  # 168 St
-    "A10",  # 163 St-Amsterdam Av
-    "A11",  # 155 St
-    "A12",  # 145 St
-    "A14",  # 135 St
-    "A15",  # 125 St
-    "A16",  # 116 St
-    "A17",  # Cathedral Pkwy (110 St)
-    "A18",  # 103 St
-    "A19",  # 96 St
-    "A20",  # 86 St
-    "A21",  # 81 St-Museum of Natural History
-    "A22",  # 72 St
-    "A24",  # 59 St-Columbus Circle
-    "A25",  # 50 St
-    "A27",  # 42 St-Port Authority Bus Terminal
-    "A28",  # 34 St-Penn Station
-    "A30",  # 23 St
-    "A31",  # 14 St
-    "A32",  # W 4 St-Wash Sq
-    "A33",  # Spring St
-    "A34",  # Canal St
-    "A36",  # Chambers St
-    "A38",  # Fulton St
-    "A40",  # High St
-    "A41",  # Jay St-MetroTech
-    "A42",  # Hoyt-Schermerhorn Sts
-    "A43",  # Lafayette Av
-    "A44",  # Clinton-Washington Avs
-    "A45",  # Franklin Av
-    "A46",  # Nostrand Av
-    "A47",  # Kingston-Throop Avs
-    "A48",  # Utica Av
-    "A49",  # Ralph Av
-    "A50",  # Rockaway Av
-    "A51",  # Broadway Junction
-    "A52",  # Liberty Av
-    "A53",  # Van Siclen Av
-    "A54",  # Shepherd Av
-    "A55"   # Euclid Av
-]
-
-# Expected terminus mapping for determining the expected destination stop in the GTFS feed.
-EXPECTED_TERMINI = {
-    "G": {
-        "G22": "F27S",  # If departed from Court Sq (north), heading southbound, expected terminus is Church Av.
-        "F27": "G22N"   # If departed from Church Av (south), expected terminus is Court Sq.
-    },
-    "C": {
-        "A09": "A55S",  # If departed from 168 St (north), heading southbound, expected terminus is Euclid Av.
-        "A55": "A09N"   # If departed from Euclid Av (south), expected terminus is 168 St.
-    }
-}
+# Stops, station sequences, termini and shapes of every line come from the line
+# registry (gtfs/lines.json, compiled to gtfs/lines.npz; see gtfs/build_lines.py).
 
 def haversine_distance(lat1, lon1, lat2, lon2):
     """Calculate the great-circle distance (in meters) between two lat/lon points."""
@@ -114,60 +31,123 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return R * c
 
+EARTH_RADIUS = 6371000  # meters
+FAST_PATH_MAX_DIST = 1000  # meters; below this the equirectangular approximation is within ~0.01% of haversine
+
+def haversine_many(lat, lon, lats, lons):
+    """One-to-many great-circle distances (in meters) from (lat, lon) to arrays of points."""
+    phi1 = np.radians(lat)
+    phi2 = np.radians(np.asarray(lats, dtype=float))
+    dphi = phi2 - phi1
+    dlambda = np.radians(np.asarray(lons, dtype=float) - lon)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def haversine_matrix(lats1, lons1, lats2, lons2):
+    """Many-to-many great-circle distances (in meters); result has shape (len(lats1), len(lats2))."""
+    lats1 = np.asarray(lats1, dtype=float)[:, None]
+    lons1 = np.asarray(lons1, dtype=float)[:, None]
+    return haversine_many(lats1, lons1, lats2, lons2)
+
+def equirectangular_matrix(lats1, lons1, lats2, lons2):
+    """
+    Many-to-many distances (in meters) using the equirectangular approximation.
+    Much cheaper than haversine and accurate for sub-kilometre distances (see FAST_PATH_MAX_DIST),
+    which covers every radius check in this module; use haversine_matrix beyond that.
+    """
+    lats1 = np.radians(np.asarray(lats1, dtype=float))[:, None]
+    lons1 = np.radians(np.asarray(lons1, dtype=float))[:, None]
+    lats2 = np.radians(np.asarray(lats2, dtype=float))
+    lons2 = np.radians(np.asarray(lons2, dtype=float))
+    x = (lons2 - lons1) * np.cos((lats1 + lats2) / 2)
+    y = lats2 - lats1
+    return EARTH_RADIUS * np.hypot(x, y)
+
+def first_within(lat, lon, coords, radius):
+    """
+    Given a dict of id -> (lat, lon), return the first id within radius meters of (lat, lon), or None.
+    """
+    if not coords:
+        return None
+    lats, lons = zip(*coords.values())
+    hits = np.flatnonzero(equirectangular_matrix([lat], [lon], lats, lons)[0] <= radius)
+    return list(coords)[hits[0]] if hits.size else None
+
 def load_stops(line="G"):
-    """Load stops from the stops file for the specified line (G or C)."""
-    filename = f"gtfs/{line.lower()}_stops.csv"
-    stops = []
-    try:
-        with open(filename, newline="") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                stops.append({
-                    "stop_id": row["stop_id"],
-                    "stop_name": row["stop_name"],
-                    "lat": float(row["stop_lat"]),
-                    "lon": float(row["stop_lon"])
-                })
-    except Exception as e:
-        print(f"Error loading stops from {filename}: {e}")
-    return stops
+    """The stops (stations and their N/S platforms) of the specified line, from the line registry."""
+    spec = get_line(line)
+    return list(spec.stops) if spec else []
 
 def load_shapes(line="G"):
-    """Load shape points from shapes.csv. Returns a list of dicts."""
-    filename = f"gtfs/{line.lower()}_shapes.csv"
-    shapes = []
-    try:
-        with open(filename, newline="") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                shapes.append({
-                    "shape_id": row["shape_id"],
-                    "shape_pt_sequence": int(row["shape_pt_sequence"]),
-                    "lat": float(row["shape_pt_lat"]),
-                    "lon": float(row["shape_pt_lon"])
-                })
-    except Exception as e:
-        print(f"Error loading shapes: {e}")
-    return shapes
+    """The shape points of the specified line, from the line registry. Returns a list of dicts."""
+    spec = get_line(line)
+    return list(spec.shapes) if spec else []
+
+@lru_cache(maxsize=None)
+def get_route_index(line="G"):
+    """
+    Build (once per process) the spatial index over the shape segments for the specified line.
+    Returns None if no shape data is available.
+    """
+    shapes = load_shapes(line)
+    if not shapes:
+        return None
+    return RouteIndex.from_shapes(shapes)
+
+@lru_cache(maxsize=None)
+def get_topology(line="G"):
+    """
+    Build (once per process) the stop lookup tables for the specified line.
+    Returns None for unsupported lines.
+    """
+    spec = get_line(line)
+    if spec is None:
+        print(f"Unsupported line: {line}")
+        return None
+    return LineTopology(line, spec.stops, spec.sequence)
+
+@lru_cache(maxsize=None)
+def get_linear_reference(line="G"):
+    """
+    Build (once per process) the chainage reference along the specified line's shape.
+    Returns None for unsupported lines or if no shape data is available.
+    """
+    spec = get_line(line)
+    if spec is None or not spec.shapes:
+        return None
+    return LinearReference.from_shapes(line, spec.shapes, spec.stops, spec.sequence)
+
+def direction_from_fixes(reports, line="G", max_reports=10):
+    """
+    Infer the direction of travel from the beacon's latest reports (sorted oldest first):
+    the latest fix is compared with the most recent earlier fix (among the last max_reports)
+    that lies at least MIN_MOVE meters away along the line. Returns "Unknown" otherwise.
+    """
+    ref = get_linear_reference(line)
+    if ref is None or len(reports) < 2:
+        return "Unknown"
+    latest, _ = ref.locate(reports[-1].latitude, reports[-1].longitude)
+    for report in reversed(reports[-max_reports:-1]):
+        earlier, _ = ref.locate(report.latitude, report.longitude)
+        direction = ref.direction(earlier, latest)
+        if direction != "Unknown":
+            return direction
+    return "Unknown"
 
 def is_on_route(lat, lon, line="G", threshold=200):
     """
     Determine if a given point (lat, lon) is within threshold meters
-    of any shape point in the shapes.csv file.
+    of the line's route geometry (its shapes in the line registry).
     """
     # Ensure threshold is a number (in case it's passed as a string)
     threshold = float(threshold)
     
-    shapes = load_shapes(line)
-    if not shapes:
+    index = get_route_index(line)
+    if index is None:
         print("No shape data available.")
         return False
-    min_distance = float('inf')
-    for pt in shapes:
-        d = haversine_distance(lat, lon, pt["lat"], pt["lon"])
-        if d < min_distance:
-            min_distance = d
-    print(f"Minimum distance from beacon to route: {min_distance} meters")
+    with span("route_check"):
+        min_distance = index.distance(lat, lon)
     return min_distance <= threshold
 
 def get_last_terminus_report(reports, line="G"):
@@ -178,51 +158,53 @@ def get_last_terminus_report(reports, line="G"):
     Returns a tuple (report, terminus_id) if found; otherwise, None.
     """
     print(f"Scanning {len(reports)} beacon reports for a terminus event on {line} line...")
-    termini = TERMINUS_COORDS_G if line == "G" else TERMINUS_COORDS_C if line == "C" else None
+    spec = get_line(line)
+    termini = spec.termini if spec else None
     if termini is None:
         print(f"Unsupported line: {line}")
         return None
     
-    reports = sorted(reports, key=lambda r: r.timestamp, reverse=True)
-    for rep in reports:
-        for term_id, (term_lat, term_lon) in termini.items():
-            distance = haversine_distance(rep.latitude, rep.longitude, term_lat, term_lon)
-            if distance <= STOP_RADIUS:
-                print(f"Terminus event found: {term_id} at {rep.timestamp}")
-                return rep, term_id
+    if not reports:
+        print("No terminus event found in beacon reports.")
+        return None
+
+    with span("terminus_scan", count=len(reports)):
+        reports = sorted(reports, key=lambda r: r.timestamp, reverse=True)
+        term_ids = list(termini)
+        term_lats, term_lons = zip(*termini.values())
+        lats = np.fromiter((rep.latitude for rep in reports), dtype=float, count=len(reports))
+        lons = np.fromiter((rep.longitude for rep in reports), dtype=float, count=len(reports))
+
+        # (reports x termini) hit matrix; the first hit row is the most recent terminus event
+        hits = equirectangular_matrix(lats, lons, term_lats, term_lons) <= STOP_RADIUS
+        hit_rows = np.flatnonzero(hits.any(axis=1))
+    if hit_rows.size:
+        rep = reports[hit_rows[0]]
+        term_id = term_ids[int(np.argmax(hits[hit_rows[0]]))]
+        print(f"Terminus event found: {term_id} at {rep.timestamp}")
+        return rep, term_id
     print("No terminus event found in beacon reports.")
     return None
 
 def get_nearest_stop(lat, lon, stops):
     """Given a point and a list of stops, return the nearest stop (and its distance)."""
-    nearest = None
-    min_dist = float('inf')
-    for stop in stops:
-        d = haversine_distance(lat, lon, stop["lat"], stop["lon"])
-        if d < min_dist:
-            min_dist = d
-            nearest = stop
-    return nearest, min_dist
+    if not stops:
+        return None, float('inf')
+    dists = haversine_many(lat, lon, [stop["lat"] for stop in stops], [stop["lon"] for stop in stops])
+    i = int(np.argmin(dists))
+    return stops[i], float(dists[i])
 
 def get_direction_from_terminus(terminus_id, line="G"):
     """
-    Determine the direction of travel based on the last terminus.
-    For G trains:
-      - If the last terminus was G22 (Court Sq, north), then the train left the north and is traveling Southbound.
-      - If the last terminus was F27 (Church Av, south), then it is traveling Northbound.
-    For C trains:
-      - If the last terminus was A09 (168 St, north), then the train is traveling Southbound.
-      - If the last terminus was A55 (Euclid Av, south), then the train is traveling Northbound.
+    Determine the direction of travel based on the last terminus: a train that last
+    left the line's north terminus (e.g. G22 Court Sq on the G) is traveling Southbound,
+    one that left the south terminus (e.g. F27 Church Av) Northbound.
     """
-    if line == "G":
-        if terminus_id == "G22":
+    spec = get_line(line)
+    if spec is not None:
+        if terminus_id == spec.north_terminus:
             return "Southbound"
-        elif terminus_id == "F27":
-            return "Northbound"
-    elif line == "C":
-        if terminus_id == "A09":
-            return "Southbound"
-        elif terminus_id == "A55":
+        elif terminus_id == spec.south_terminus:
             return "Northbound"
     return "Unknown"
 
@@ -231,13 +213,11 @@ def get_next_stop(current_stop_id, direction, stops, line="G"):
     Given a current stop id, direction, and a list of stops (ordered by route),
     return the next stop along the route for the specified line.
     """
-    if line == "G":
-        sequence = STOP_SEQUENCE_G
-    elif line == "C":
-        sequence = STOP_SEQUENCE_C
-    else:
+    spec = get_line(line)
+    if spec is None:
         print(f"Unsupported line: {line}")
         return None
+    sequence = spec.sequence
     
     try:
         index = sequence.index(current_stop_id)
@@ -257,30 +237,39 @@ def get_next_stop(current_stop_id, direction, stops, line="G"):
     return None
 
 # ----- Beacon & GTFS Matching Functions -----
-def match_gtfs_train(reports, line="G"):
+def match_gtfs_train(reports, line="G", feeds=None, state=None):
     """
     Fetch beacon reports using the provided private key, then scan the history
     to find the most recent time the train was at one of the termini for the specified line.
     Using that terminus event's timestamp (converted to Eastern time),
-    look for a train (from the NYCTFeed) whose departure_time is within ±3 minutes.
+    look for the train (from the NYCTFeed) whose departure_time is closest to it, within ±4 minutes.
+    feeds is an optional FeedCache to read the snapshot from (the process-wide cache otherwise).
+    state is an optional BeaconState (already advanced past reports); its last terminus
+    event is used instead of rescanning reports.
     Returns the matching train (if found) or None.
     """
     
-    if not reports:
-        print("No beacon reports available.")
-        return None, None
-    
-    last_term_result = get_last_terminus_report(reports, line)
-    if not last_term_result:
-        print("No terminus event found in beacon history.")
-        return None, None
-    
-    term_report, term_id = last_term_result
-    print(f"Last terminus event on {line} line: {term_id} at {term_report.timestamp}")
+    if state is not None:
+        if state.last_terminus_id is None:
+            print("No terminus event recorded for this beacon.")
+            return None, None
+        term_id, term_timestamp = state.last_terminus_id, state.last_terminus_at
+    else:
+        if not reports:
+            print("No beacon reports available.")
+            return None, None
+
+        last_term_result = get_last_terminus_report(reports, line)
+        if not last_term_result:
+            print("No terminus event found in beacon history.")
+            return None, None
+
+        term_report, term_id = last_term_result
+        term_timestamp = term_report.timestamp
+    print(f"Last terminus event on {line} line: {term_id} at {term_timestamp}")
     
     # Convert terminus event timestamp to Eastern time and keep it offset-aware.
-    eastern = pytz.timezone("US/Eastern")
-    term_time_eastern = term_report.timestamp.astimezone(eastern)
+    term_time_eastern = term_timestamp.astimezone(ZoneInfo("US/Eastern"))
     print(f"Terminus event time in Eastern: {term_time_eastern}")
     
     # For comparison with train.departure_time, we assume departure_time is Eastern offset-naive,
@@ -289,23 +278,20 @@ def match_gtfs_train(reports, line="G"):
     print(f"Using terminus event time (naive Eastern): {matching_time}")
     
     # Load the realtime GTFS feed for the specified line.
-    print(f"Loading GTFS feed for {line} trains...")
-    feed = NYCTFeed(line)
+    feed = (feeds or shared_feeds).get(line)
     
-    expected_terminus = EXPECTED_TERMINI.get(line, {}).get(term_id)
+    spec = get_line(line)
+    expected_terminus = spec.expected_termini.get(term_id) if spec else None
     if not expected_terminus:
         print(f"Unexpected terminus id {term_id} for line {line}.")
         return None, term_id
     
-    trains = feed.filter_trips(line_id=[line], headed_for_stop_id=expected_terminus, underway=True)
-    print(f"GTFS feed loaded; {len(feed.trips)} trips found for line {line}.")
-    
-    for train in trains:
-        diff = abs((train.departure_time - matching_time).total_seconds())
-        print(f"Train {train.trip_id} departure_time: {train.departure_time}, diff: {diff} seconds")
-        if diff <= MATCH_WINDOW_SEC:
-            print(f"Matching GTFS train found: {train.trip_id} (diff: {diff} seconds)")
-            return train, term_id
+    with span("trip_match"):
+        train, diff = feed.nearest_departure(line, expected_terminus, matching_time, MATCH_WINDOW_SEC)
+    print(f"GTFS feed loaded; {len(feed.departures(line, expected_terminus)[1])} underway trips headed for {expected_terminus}.")
+    if train:
+        print(f"Matching GTFS train found: {train.trip_id} (diff: {diff} seconds)")
+        return train, term_id
         
-    print("No matching GTFS train found within ±3 minutes of the terminus event.")
+    print(f"No matching GTFS train found within ±{MATCH_WINDOW_SEC} seconds of the terminus event.")
     return None, term_id
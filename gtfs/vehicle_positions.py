@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from os.path import join
+import requests
+from psycopg2.extras import Json, execute_values
+# gtfs-realtime.proto can only be registered once per process; reuse the copy nyct_gtfs (api/index.py) loads
+from nyct_gtfs.compiled_gtfs.gtfs_realtime_pb2 import FeedMessage
+from gtfs.feeds import MTA_FEED_BASE, MTA_FEEDS
+
+# Comma-separated feed names to archive (all of them by default)
+VEHICLE_FEEDS = [name.strip() for name in os.environ.get("VEHICLE_FEEDS", ",".join(MTA_FEEDS)).split(",") if name.strip()]
+FETCH_WORKERS = int(os.environ.get("VEHICLE_FETCH_WORKERS", "8"))
+FETCH_TIMEOUT_SEC = 10
+
+INSERT_POSITIONS = """
+INSERT INTO "VehiclePosition" ("fetchId", "entityId", "tripId", "routeId", "startTime", "startDate", "scheduleRelationship", "stopId", "stopLat", "stopLon", "currentStatus", "timestamp")
+VALUES %s
+"""
+
+INSERT_FETCH = """
+INSERT INTO "GtfsFetch" ("feedName", "fetchTime", "feedTimestamp") VALUES (%s, now(), %s) RETURNING id
+"""
+
+SELECT_FEED_STATES = """
+SELECT "feedName", etag, "lastModified", "headerTimestamp", "contentDigest", "entityFingerprints"
+FROM "GtfsFeedState"
+WHERE "feedName" = ANY(%s)
+"""
+
+UPSERT_FEED_STATES = """
+INSERT INTO "GtfsFeedState" ("feedName", etag, "lastModified", "headerTimestamp", "contentDigest", "entityFingerprints", "updatedAt")
+VALUES %s
+ON CONFLICT ("feedName") DO UPDATE SET
+    etag = EXCLUDED.etag,
+    "lastModified" = EXCLUDED."lastModified",
+    "headerTimestamp" = EXCLUDED."headerTimestamp",
+    "contentDigest" = EXCLUDED."contentDigest",
+    "entityFingerprints" = EXCLUDED."entityFingerprints",
+    "updatedAt" = EXCLUDED."updatedAt"
+"""
+
+class FeedState:
+    """
+    What a feed looked like when it was last stored. Entity fingerprints are keyed by trip id:
+    MTA entity ids are just positions in the feed and change from one snapshot to the next.
+    """
+
+    __slots__ = ("name", "etag", "last_modified", "header_timestamp", "digest", "fingerprints")
+
+    def __init__(self, name, etag=None, last_modified=None, header_timestamp=None, digest=None, fingerprints=None):
+        self.name = name
+        self.etag = etag
+        self.last_modified = last_modified
+        self.header_timestamp = header_timestamp
+        self.digest = digest
+        self.fingerprints = fingerprints or {}
+
+    def as_row(self):
+        """Column values for an upsert into "GtfsFeedState"."""
+        return (self.name, self.etag, self.last_modified, self.header_timestamp, self.digest,
+                Json(self.fingerprints), datetime.now(timezone.utc).replace(tzinfo=None))
+
+
+class FeedResult:
+    """
+    Outcome of polling one feed. status is "not_modified" (HTTP 304), "unchanged"
+    (same bytes or same header timestamp as last time) or "changed", in which case
+    positions holds entity key -> row values without the fetch id, and changed lists
+    the keys whose values differ from the stored snapshot.
+    """
+
+    __slots__ = ("name", "status", "state", "positions", "changed")
+
+    def __init__(self, name, status, state, positions=None, changed=()):
+        self.name = name
+        self.status = status
+        self.state = state
+        self.positions = positions or {}
+        self.changed = list(changed)
+
+_session = None
+
+def get_session():
+    """A process-wide HTTP session, so connections to the MTA API are reused across feeds and runs."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS)
+        _session.mount("https://", adapter)
+    return _session
+
+@lru_cache(maxsize=None)
+def load_stop_coords():
+    """stop_id -> (lat, lon) for every subway stop, read once per process."""
+    with open(join("gtfs", "stops.json"), "r") as f:
+        stops = json.load(f)
+    return {
+        stop_id: (float(stop["stop_lat"]), float(stop["stop_lon"]))
+        for stop_id, stop in stops.items()
+        if "stop_lat" in stop  # the file has an empty "" entry
+    }
+
+def _fingerprint(values):
+    """Hash of a position's column values, leaving out the entity id (values[0]): it is the
+    entity's place in the feed, so one trip added or removed would renumber all after it."""
+    return hashlib.blake2b(repr(values[1:]).encode(), digest_size=8).hexdigest()
+
+def load_feed_states(cur, names):
+    """Stored FeedState of each named feed (a blank one for feeds never stored)."""
+    states = {name: FeedState(name) for name in names}
+    cur.execute(SELECT_FEED_STATES, (list(names),))
+    for name, etag, last_modified, header_timestamp, digest, fingerprints in cur.fetchall():
+        states[name] = FeedState(name, etag, last_modified, header_timestamp, digest, fingerprints)
+    return states
+
+def save_feed_states(cur, states):
+    rows = [state.as_row() for state in states]
+    if rows:
+        execute_values(cur, UPSERT_FEED_STATES, rows)
+
+def fetch_feed(name, session=None, state=None):
+    """
+    Download and parse one realtime feed, returning a FeedResult.
+    With the feed's previous state, the request is conditional (If-None-Match /
+    If-Modified-Since, where the upstream supports them) and parsing is skipped when
+    the body is byte-for-byte the same as last time.
+    """
+    session = session or get_session()
+    state = state or FeedState(name)
+    headers = {}
+    if state.etag:
+        headers["If-None-Match"] = state.etag
+    if state.last_modified:
+        headers["If-Modified-Since"] = state.last_modified
+    response = session.get(MTA_FEED_BASE + MTA_FEEDS[name], headers=headers, timeout=FETCH_TIMEOUT_SEC)
+    if response.status_code == 304:
+        return FeedResult(name, "not_modified", state)
+    response.raise_for_status()
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    new_state = FeedState(name, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                          state.header_timestamp, digest, state.fingerprints)
+    if digest == state.digest:
+        return FeedResult(name, "unchanged", new_state)
+
+    feed = FeedMessage()
+    feed.ParseFromString(response.content)
+    header_timestamp = datetime.fromtimestamp(feed.header.timestamp, timezone.utc).replace(tzinfo=None) \
+        if feed.header.HasField("timestamp") else None
+    new_state.header_timestamp = header_timestamp
+    if header_timestamp is not None and header_timestamp == state.header_timestamp:
+        return FeedResult(name, "unchanged", new_state)
+
+    positions = position_values(feed)
+    new_state.fingerprints = {key: _fingerprint(values) for key, values in positions.items()}
+    changed = [key for key, fp in new_state.fingerprints.items() if state.fingerprints.get(key) != fp]
+    return FeedResult(name, "changed", new_state, positions, changed)
+
+def position_values(feed):
+    """
+    Entity key (trip id, or entity id for vehicles without a trip) -> column values
+    for a "VehiclePosition" INSERT, without the fetch id, for every vehicle entity in the feed.
+    """
+    stops = load_stop_coords()
+    positions = {}
+    for entity in feed.entity:
+        if not entity.HasField("vehicle"):
+            continue
+        vehicle = entity.vehicle
+        stop_id = vehicle.stop_id if vehicle.HasField("stop_id") else None
+        stop_lat, stop_lon = stops.get(stop_id, (None, None))
+        positions[vehicle.trip.trip_id or entity.id] = (
+            entity.id,
+            vehicle.trip.trip_id,
+            vehicle.trip.route_id,
+            vehicle.trip.start_time,
+            vehicle.trip.start_date,
+            vehicle.trip.schedule_relationship,
+            stop_id,
+            stop_lat,
+            stop_lon,
+            vehicle.current_status if vehicle.HasField("current_status") else None,
+            datetime.fromtimestamp(vehicle.timestamp) if vehicle.HasField("timestamp") else None,
+        )
+    return positions
+
+def poll_feeds(states, workers=FETCH_WORKERS):
+    """
+    Poll every feed in states (name -> FeedState) concurrently, one worker per feed.
+    Returns (results, errors) where errors maps feed name -> message for feeds that failed;
+    one bad feed does not stop the others from being archived.
+    """
+    session = get_session()
+    load_stop_coords()  # load before the workers start, so they don't all read the file
+
+    results, errors = [], {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(states)))) as pool:
+        futures = {name: pool.submit(fetch_feed, name, session, state) for name, state in states.items()}
+        for name, future in futures.items():
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Error fetching {name} feed: {e}")
+                errors[name] = str(e)
+    return results, errors
+
+def store_feeds(cur, results):
+    """
+    Write a GtfsFetch record (with the feed's own header timestamp) for each changed
+    feed and the positions of the entities that changed since its last snapshot, all
+    positions in one statement, then remember every feed's new state.
+    Returns the number of positions written.
+    """
+    rows = []
+    for result in results:
+        if result.status != "changed":
+            continue
+        cur.execute(INSERT_FETCH, (result.name, result.state.header_timestamp or datetime.now(timezone.utc).replace(tzinfo=None)))
+        fetch_id = cur.fetchone()[0]
+        rows.extend((fetch_id, *result.positions[key]) for key in result.changed)
+    insert_positions(cur, rows)
+    save_feed_states(cur, [result.state for result in results if result.status != "not_modified"])
+    return len(rows)
+
+def insert_positions(cur, rows, page_size=5000):
+    """Insert every vehicle position of a run in as few statements as possible."""
+    if rows:
+        execute_values(cur, INSERT_POSITIONS, rows, page_size=page_size)
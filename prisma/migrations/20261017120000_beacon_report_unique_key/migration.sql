@@ -0,0 +1,16 @@
+/*
+  Warnings:
+
+  - Duplicate rows in `BeaconReport` (same `beaconId`, `hashedAdvKey` and `timestamp`) are removed, keeping the oldest row.
+
+*/
+-- DeleteDuplicates
+DELETE FROM "BeaconReport" a
+USING "BeaconReport" b
+WHERE a."beaconId" = b."beaconId"
+  AND a."hashedAdvKey" = b."hashedAdvKey"
+  AND a."timestamp" = b."timestamp"
+  AND a."id" > b."id";
+
+-- CreateIndex
+CREATE UNIQUE INDEX "BeaconReport_beaconId_hashedAdvKey_timestamp_key" ON "BeaconReport"("beaconId", "hashedAdvKey", "timestamp");
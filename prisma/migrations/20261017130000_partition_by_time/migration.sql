@@ -0,0 +1,126 @@
+/*
+  Warnings:
+
+  - `BeaconReport`, `VehiclePosition` and `BeaconTripMapping` are rebuilt as range-partitioned tables and their rows copied over.
+  - The primary keys now include the partition column, as Postgres requires for partitioned tables.
+  - Partitions are rolled forward and dropped by /api/prune.py (gtfs/retention.py); the names created here follow the same scheme.
+  - /api/prune.py permanently deletes every row older than its table's retention, including the history copied over here: `BeaconReport` after BEACON_REPORT_RETENTION_HOURS (default 4), `VehiclePosition` after VEHICLE_POSITION_RETENTION_DAYS and `BeaconTripMapping` after TRIP_MAPPING_RETENTION_DAYS (both unset by default, which keeps everything). Set these before the first prune run.
+
+*/
+-- BeaconReport: hourly partitions on "timestamp"
+ALTER TABLE "BeaconReport" RENAME TO "BeaconReport_old";
+ALTER TABLE "BeaconReport_old" RENAME CONSTRAINT "BeaconReport_pkey" TO "BeaconReport_old_pkey";
+ALTER TABLE "BeaconReport_old" RENAME CONSTRAINT "BeaconReport_fetchId_fkey" TO "BeaconReport_old_fetchId_fkey";
+ALTER INDEX "BeaconReport_beaconId_hashedAdvKey_timestamp_key" RENAME TO "BeaconReport_old_beaconId_hashedAdvKey_timestamp_key";
+ALTER SEQUENCE "BeaconReport_id_seq" OWNED BY NONE;
+
+CREATE TABLE "BeaconReport" (
+    "id" INTEGER NOT NULL DEFAULT nextval('"BeaconReport_id_seq"'),
+    "fetchId" INTEGER NOT NULL,
+    "beaconId" TEXT NOT NULL,
+    "hashedAdvKey" TEXT NOT NULL,
+    "timestamp" TIMESTAMP(3) NOT NULL,
+    "latitude" DOUBLE PRECISION NOT NULL,
+    "longitude" DOUBLE PRECISION NOT NULL,
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "BeaconReport_pkey" PRIMARY KEY ("id", "timestamp")
+) PARTITION BY RANGE ("timestamp");
+
+ALTER SEQUENCE "BeaconReport_id_seq" OWNED BY "BeaconReport"."id";
+CREATE UNIQUE INDEX "BeaconReport_beaconId_hashedAdvKey_timestamp_key" ON "BeaconReport"("beaconId", "hashedAdvKey", "timestamp");
+ALTER TABLE "BeaconReport" ADD CONSTRAINT "BeaconReport_fetchId_fkey" FOREIGN KEY ("fetchId") REFERENCES "GtfsFetch"("id") ON DELETE RESTRICT ON UPDATE CASCADE;
+CREATE TABLE "BeaconReport_default" PARTITION OF "BeaconReport" DEFAULT;
+
+-- VehiclePosition: daily partitions on "createdAt"
+ALTER TABLE "VehiclePosition" RENAME TO "VehiclePosition_old";
+ALTER TABLE "VehiclePosition_old" RENAME CONSTRAINT "VehiclePosition_pkey" TO "VehiclePosition_old_pkey";
+ALTER TABLE "VehiclePosition_old" RENAME CONSTRAINT "VehiclePosition_fetchId_fkey" TO "VehiclePosition_old_fetchId_fkey";
+ALTER INDEX "VehiclePosition_fetchId_idx" RENAME TO "VehiclePosition_old_fetchId_idx";
+ALTER INDEX "VehiclePosition_tripId_idx" RENAME TO "VehiclePosition_old_tripId_idx";
+ALTER INDEX "VehiclePosition_routeId_idx" RENAME TO "VehiclePosition_old_routeId_idx";
+ALTER INDEX "VehiclePosition_stopId_idx" RENAME TO "VehiclePosition_old_stopId_idx";
+ALTER SEQUENCE "VehiclePosition_id_seq" OWNED BY NONE;
+
+CREATE TABLE "VehiclePosition" (
+    "id" INTEGER NOT NULL DEFAULT nextval('"VehiclePosition_id_seq"'),
+    "fetchId" INTEGER NOT NULL,
+    "entityId" TEXT NOT NULL,
+    "tripId" TEXT,
+    "routeId" TEXT,
+    "startTime" TEXT,
+    "startDate" TEXT,
+    "scheduleRelationship" INTEGER,
+    "stopId" TEXT,
+    "stopLat" DOUBLE PRECISION,
+    "stopLon" DOUBLE PRECISION,
+    "currentStatus" INTEGER,
+    "timestamp" TIMESTAMP(3),
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "VehiclePosition_pkey" PRIMARY KEY ("id", "createdAt")
+) PARTITION BY RANGE ("createdAt");
+
+ALTER SEQUENCE "VehiclePosition_id_seq" OWNED BY "VehiclePosition"."id";
+CREATE INDEX "VehiclePosition_fetchId_idx" ON "VehiclePosition"("fetchId");
+CREATE INDEX "VehiclePosition_tripId_idx" ON "VehiclePosition"("tripId");
+CREATE INDEX "VehiclePosition_routeId_idx" ON "VehiclePosition"("routeId");
+CREATE INDEX "VehiclePosition_stopId_idx" ON "VehiclePosition"("stopId");
+ALTER TABLE "VehiclePosition" ADD CONSTRAINT "VehiclePosition_fetchId_fkey" FOREIGN KEY ("fetchId") REFERENCES "GtfsFetch"("id") ON DELETE RESTRICT ON UPDATE CASCADE;
+CREATE TABLE "VehiclePosition_default" PARTITION OF "VehiclePosition" DEFAULT;
+
+-- BeaconTripMapping: daily partitions on "createdAt"
+ALTER TABLE "BeaconTripMapping" RENAME TO "BeaconTripMapping_old";
+ALTER TABLE "BeaconTripMapping_old" RENAME CONSTRAINT "BeaconTripMapping_pkey" TO "BeaconTripMapping_old_pkey";
+ALTER TABLE "BeaconTripMapping_old" RENAME CONSTRAINT "BeaconTripMapping_fetchId_fkey" TO "BeaconTripMapping_old_fetchId_fkey";
+ALTER SEQUENCE "BeaconTripMapping_id_seq" OWNED BY NONE;
+
+CREATE TABLE "BeaconTripMapping" (
+    "id" INTEGER NOT NULL DEFAULT nextval('"BeaconTripMapping_id_seq"'),
+    "fetchId" INTEGER NOT NULL,
+    "tripId" TEXT NOT NULL,
+    "beaconId" TEXT NOT NULL,
+    "latestBeaconReport" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "BeaconTripMapping_pkey" PRIMARY KEY ("id", "createdAt")
+) PARTITION BY RANGE ("createdAt");
+
+ALTER SEQUENCE "BeaconTripMapping_id_seq" OWNED BY "BeaconTripMapping"."id";
+ALTER TABLE "BeaconTripMapping" ADD CONSTRAINT "BeaconTripMapping_fetchId_fkey" FOREIGN KEY ("fetchId") REFERENCES "GtfsFetch"("id") ON DELETE RESTRICT ON UPDATE CASCADE;
+CREATE TABLE "BeaconTripMapping_default" PARTITION OF "BeaconTripMapping" DEFAULT;
+
+-- CreatePartitions (retention window plus two days ahead, in UTC)
+DO $$
+DECLARE
+    t TIMESTAMP;
+    now_utc TIMESTAMP := now() AT TIME ZONE 'UTC';
+BEGIN
+    FOR t IN SELECT generate_series(date_trunc('hour', now_utc) - INTERVAL '4 hours', date_trunc('hour', now_utc) + INTERVAL '2 days', INTERVAL '1 hour') LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF "BeaconReport" FOR VALUES FROM (%L) TO (%L)',
+            'BeaconReport_p' || to_char(t, 'YYYYMMDDHH24'), t, t + INTERVAL '1 hour');
+    END LOOP;
+    FOR t IN SELECT generate_series(date_trunc('day', now_utc) - INTERVAL '7 days', date_trunc('day', now_utc) + INTERVAL '2 days', INTERVAL '1 day') LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF "VehiclePosition" FOR VALUES FROM (%L) TO (%L)',
+            'VehiclePosition_p' || to_char(t, 'YYYYMMDD'), t, t + INTERVAL '1 day');
+    END LOOP;
+    FOR t IN SELECT generate_series(date_trunc('day', now_utc) - INTERVAL '30 days', date_trunc('day', now_utc) + INTERVAL '2 days', INTERVAL '1 day') LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF "BeaconTripMapping" FOR VALUES FROM (%L) TO (%L)',
+            'BeaconTripMapping_p' || to_char(t, 'YYYYMMDD'), t, t + INTERVAL '1 day');
+    END LOOP;
+END $$;
+
+-- CopyData
+INSERT INTO "BeaconReport" ("id", "fetchId", "beaconId", "hashedAdvKey", "timestamp", "latitude", "longitude", "createdAt")
+SELECT "id", "fetchId", "beaconId", "hashedAdvKey", "timestamp", "latitude", "longitude", "createdAt" FROM "BeaconReport_old";
+
+INSERT INTO "VehiclePosition" ("id", "fetchId", "entityId", "tripId", "routeId", "startTime", "startDate", "scheduleRelationship", "stopId", "stopLat", "stopLon", "currentStatus", "timestamp", "createdAt")
+SELECT "id", "fetchId", "entityId", "tripId", "routeId", "startTime", "startDate", "scheduleRelationship", "stopId", "stopLat", "stopLon", "currentStatus", "timestamp", "createdAt" FROM "VehiclePosition_old";
+
+INSERT INTO "BeaconTripMapping" ("id", "fetchId", "tripId", "beaconId", "latestBeaconReport", "createdAt")
+SELECT "id", "fetchId", "tripId", "beaconId", "latestBeaconReport", "createdAt" FROM "BeaconTripMapping_old";
+
+-- DropTable
+DROP TABLE "BeaconReport_old";
+DROP TABLE "VehiclePosition_old";
+DROP TABLE "BeaconTripMapping_old";
@@ -0,0 +1,13 @@
+-- CreateTable
+CREATE TABLE "BeaconState" (
+    "beaconId" TEXT NOT NULL,
+    "line" TEXT NOT NULL,
+    "lastTerminusId" TEXT,
+    "lastTerminusAt" TIMESTAMP(3),
+    "highWaterMark" TIMESTAMP(3),
+    "direction" TEXT,
+    "tripId" TEXT,
+    "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "BeaconState_pkey" PRIMARY KEY ("beaconId")
+);
@@ -0,0 +1,12 @@
+-- CreateTable
+CREATE TABLE "GtfsFeedState" (
+    "feedName" TEXT NOT NULL,
+    "etag" TEXT,
+    "lastModified" TEXT,
+    "headerTimestamp" TIMESTAMP(3),
+    "contentDigest" TEXT,
+    "entityFingerprints" JSONB NOT NULL DEFAULT '{}',
+    "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "GtfsFeedState_pkey" PRIMARY KEY ("feedName")
+);
@@ -0,0 +1,23 @@
+-- CreateTable
+CREATE TABLE "BeaconStatus" (
+    "beaconId" TEXT NOT NULL,
+    "line" TEXT NOT NULL,
+    "status" TEXT NOT NULL,
+    "reason" TEXT,
+    "latitude" DOUBLE PRECISION,
+    "longitude" DOUBLE PRECISION,
+    "reportedAt" TIMESTAMP(3),
+    "tripId" TEXT,
+    "latestBeaconReport" TIMESTAMP(3),
+    "nextStopId" TEXT,
+    "nextStopName" TEXT,
+    "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "BeaconStatus_pkey" PRIMARY KEY ("beaconId")
+);
+
+-- Seed from the latest trip mapping of each beacon, so /api/rideid keeps its answers
+INSERT INTO "BeaconStatus" ("beaconId", "line", "status", "tripId", "latestBeaconReport", "updatedAt")
+SELECT DISTINCT ON ("beaconId") "beaconId", 'unknown', 'matched', "tripId", "latestBeaconReport", CURRENT_TIMESTAMP
+FROM "BeaconTripMapping"
+ORDER BY "beaconId", "latestBeaconReport" DESC;
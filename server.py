@@ -0,0 +1,93 @@
+"""
+Long-running server for self-hosting the API handlers.
+
+Unlike a serverless invocation, this process keeps the database pool, the GTFS feed
+cache and the parsed stops/shapes warm between requests, and serves requests on
+separate threads.
+
+    python server.py --port 8000 --every 30
+
+--every N also triggers /api/index.py in-process every N seconds.
+"""
+import argparse
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+LINES = ("G", "C")
+
+
+class _Router(BaseHTTPRequestHandler):
+    routes = {}
+
+    def do_GET(self):
+        route = self.routes.get(urlparse(self.path).path)
+        if route is None:
+            self.send_error(404)
+            return
+        # Finish the request as an instance of the route's own handler class, so that its
+        # methods resolve exactly as they do on Vercel, whatever other handlers define.
+        router = self.__class__
+        self.__class__ = route
+        try:
+            self.do_GET()
+        finally:
+            self.__class__ = router
+
+
+def make_router(routes):
+    """Build a request handler class that dispatches each GET on its path to routes[path]."""
+    return type("Router", (_Router,), {"routes": routes})
+
+
+def default_routes():
+    from api import index, prune, session, test
+
+    return {
+        "/api/index.py": index.handler,
+        "/api/test.py": test.handler,
+        "/api/prune.py": prune.handler,
+        "/api/session.py": session.handler,
+    }
+
+
+def warm_up():
+    """Load everything a request would otherwise load on first use."""
+    from gtfs.db import get_pool
+    from gtfs.utils import get_route_index, get_topology
+
+    get_pool()
+    for line in LINES:
+        get_route_index(line)
+        get_topology(line)
+
+
+def _tick(url, every):
+    while True:
+        time.sleep(every)
+        try:
+            with urllib.request.urlopen(url, timeout=max(every * 4, 60)) as resp:
+                resp.read()
+        except Exception as e:
+            print(f"Scheduled run of {url} failed: {e}")
+
+
+def serve(routes=None, port=8000, every=None):
+    routes = routes or default_routes()
+    warm_up()
+    httpd = ThreadingHTTPServer(("", port), make_router(routes))
+    if every:
+        url = f"http://127.0.0.1:{port}/api/index.py"
+        threading.Thread(target=_tick, args=(url, every), daemon=True).start()
+    print(f"Server running on port {port}...")
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--every", type=float, default=None, help="run /api/index.py every N seconds")
+    args = parser.parse_args()
+    serve(port=args.port, every=args.every)
@@ -1,6 +1,7 @@
 import { logger, schedules } from "@trigger.dev/sdk/v3";
 import GtfsRealtimeBindings from "gtfs-realtime-bindings";
-import { PrismaClient } from "@prisma/client";
+import { Prisma, PrismaClient } from "@prisma/client";
+import { createHash } from "crypto";
 import { loadStopsData } from '@/gtfs/get_stop_data';
 
 
@@ -19,6 +20,10 @@ const MTA_FEEDS = [
     }
 ];
 
+// /api/test.py archives the same feeds and keeps its GtfsFeedState under the bare feed name,
+// with its own validators and fingerprints; this task's rows are kept apart under this prefix.
+const FEED_STATE_PREFIX = "trigger:";
+
 export const fetchMtaGtfsData = schedules.task({
     id: "fetch-mta-gtfs-data",
     // Runs at the start of every hour
@@ -37,9 +42,22 @@ export const fetchMtaGtfsData = schedules.task({
         logger.log(`Fetching ${feed.name} data`);
         
         try {
-          // Fetch GTFS realtime data
-          const response = await fetch(feed.url, {
+          // What the feed looked like when it was last stored
+          const state = await prisma.gtfsFeedState.findUnique({
+            where: { feedName: FEED_STATE_PREFIX + feed.name },
           });
+          const previousFingerprints = (state?.entityFingerprints ?? {}) as Record<string, string>;
+
+          // Fetch GTFS realtime data, conditionally if the upstream gave us validators last time
+          const headers: Record<string, string> = {};
+          if (state?.etag) headers["If-None-Match"] = state.etag;
+          if (state?.lastModified) headers["If-Modified-Since"] = state.lastModified;
+          const response = await fetch(feed.url, { headers });
+
+          if (response.status === 304) {
+            logger.log(`${feed.name} feed not modified`);
+            continue;
+          }
   
           if (!response.ok) {
             throw new Error(`Failed to fetch data: ${response.statusText}`);
@@ -47,6 +65,18 @@ export const fetchMtaGtfsData = schedules.task({
   
           // Get response as array buffer
           const buffer = await response.arrayBuffer();
+          const contentDigest = createHash("sha256").update(Buffer.from(buffer)).digest("hex");
+          const validators = {
+            etag: response.headers.get("etag"),
+            lastModified: response.headers.get("last-modified"),
+            contentDigest,
+          };
+
+          if (state && contentDigest === state.contentDigest) {
+            await saveFeedState(feed.name, validators);
+            logger.log(`${feed.name} feed unchanged`);
+            continue;
+          }
           
           // Parse the GTFS realtime data
           const feedMessage = GtfsRealtimeBindings.transit_realtime.FeedMessage.decode(
@@ -74,6 +104,12 @@ export const fetchMtaGtfsData = schedules.task({
             entityCount: feedMessage.entity.length,
             feedTimestamp
           });
+
+          if (state?.headerTimestamp && feedMessage.header.timestamp && state.headerTimestamp.getTime() === feedTimestamp.getTime()) {
+            await saveFeedState(feed.name, validators);
+            logger.log(`${feed.name} feed has the same header timestamp as the last snapshot`);
+            continue;
+          }
   
           // Create a record of this fetch
           const fetchRecord = await prisma.gtfsFetch.create({
@@ -85,12 +121,22 @@ export const fetchMtaGtfsData = schedules.task({
           });
   
           const vehiclePositions = [];
+          const entityFingerprints: Record<string, string> = {};
   
-          // Process all entities in the feed
+          // Process all entities in the feed, keeping only those that changed since the last snapshot.
+          // Entities are keyed by trip id: MTA entity ids are just positions in the feed.
           for (const entity of feedMessage.entity) {
             if (entity.vehicle) {
               // Prepare vehicle position data
-              vehiclePositions.push(prepareVehiclePosition(entity, fetchRecord.id));
+              const position = prepareVehiclePosition(entity, fetchRecord.id);
+              const key = position.tripId || String(entity.id);
+              // The entity id is left out: one trip added or removed would renumber every entity after it
+              const { fetchId: _fetchId, entityId: _entityId, ...fingerprinted } = position;
+              const fingerprint = createHash("sha256").update(JSON.stringify(fingerprinted)).digest("hex").slice(0, 16);
+              entityFingerprints[key] = fingerprint;
+              if (previousFingerprints[key] !== fingerprint) {
+                vehiclePositions.push(position);
+              }
             }
           }
   
@@ -99,8 +145,14 @@ export const fetchMtaGtfsData = schedules.task({
             await prisma.vehiclePosition.createMany({
               data: vehiclePositions,
             });
-            logger.log(`Stored ${vehiclePositions.length} vehicle positions`);
+            logger.log(`Stored ${vehiclePositions.length} changed vehicle positions`);
           }
+
+          await saveFeedState(feed.name, {
+            ...validators,
+            headerTimestamp: feedMessage.header.timestamp ? feedTimestamp : null,
+            entityFingerprints,
+          });
   
           logger.log(`Completed processing ${feed.name} feed`);
         } catch (error) {
@@ -119,6 +171,22 @@ export const fetchMtaGtfsData = schedules.task({
   });
   
   
+  async function saveFeedState(feedName: string, data: {
+    etag: string | null,
+    lastModified: string | null,
+    contentDigest: string,
+    headerTimestamp?: Date | null,
+    entityFingerprints?: Record<string, string>,
+  }) {
+    const values = { ...data, updatedAt: new Date() } as Prisma.GtfsFeedStateUpdateInput;
+    const key = FEED_STATE_PREFIX + feedName;
+    await prisma.gtfsFeedState.upsert({
+      where: { feedName: key },
+      update: values,
+      create: { feedName: key, ...values } as Prisma.GtfsFeedStateCreateInput,
+    });
+  }
+
   function prepareVehiclePosition(entity: GtfsRealtimeBindings.transit_realtime.IFeedEntity, fetchId: number) {
     const vehicle = entity.vehicle;
   